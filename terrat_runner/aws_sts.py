@@ -0,0 +1,184 @@
+# A minimal AWS STS client for the credential exchanges of the oidc step, so
+# that they do not have to start the AWS CLI.  AssumeRoleWithWebIdentity is an
+# unsigned request, AssumeRole is signed with Signature Version 4 using the
+# credentials from the web identity.
+import datetime
+import hashlib
+import hmac
+import logging
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import requests_retry
+import retry
+
+
+API_VERSION = '2011-06-15'
+
+NS = {'sts': 'https://sts.amazonaws.com/doc/2011-06-15/'}
+
+SERVICE = 'sts'
+
+CONTENT_TYPE = 'application/x-www-form-urlencoded; charset=utf-8'
+
+TRIES = 3
+INITIAL_SLEEP = 2
+BACKOFF = 1.5
+MAX_SLEEP = 10
+
+# Errors which are worth trying again, any other error is a problem with the
+# request, such as a role that cannot be assumed.
+RETRYABLE_ERROR_CODES = ['IDPCommunicationError', 'Throttling']
+
+
+class Sts_error(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super().__init__('{}: {}'.format(code, message))
+
+
+def endpoint(region, override=None):
+    if override:
+        return override
+    elif region.startswith('cn-'):
+        return 'https://sts.{}.amazonaws.com.cn'.format(region)
+    else:
+        return 'https://sts.{}.amazonaws.com'.format(region)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def _sign(url, region, credentials, body, now):
+    """Return the headers for a SigV4 signed POST of [body] to [url]."""
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+
+    headers = {
+        'content-type': CONTENT_TYPE,
+        'host': urllib.parse.urlparse(url).netloc,
+        'x-amz-date': amz_date,
+    }
+
+    if credentials.get('session_token'):
+        headers['x-amz-security-token'] = credentials['session_token']
+
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([
+        'POST',
+        urllib.parse.urlparse(url).path or '/',
+        '',
+        ''.join('{}:{}\n'.format(k, headers[k].strip()) for k in sorted(headers)),
+        signed_headers,
+        hashlib.sha256(body).hexdigest(),
+    ])
+
+    scope = '/'.join([date, region, SERVICE, 'aws4_request'])
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+
+    key = _hmac(('AWS4' + credentials['secret_access_key']).encode('utf-8'), date)
+    for part in [region, SERVICE, 'aws4_request']:
+        key = _hmac(key, part)
+
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    headers['authorization'] = ('AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, '
+                                'Signature={}').format(credentials['access_key_id'],
+                                                       scope,
+                                                       signed_headers,
+                                                       signature)
+    return headers
+
+
+def _parse_credentials(res):
+    try:
+        root = ET.fromstring(res.content)
+    except ET.ParseError:
+        raise Sts_error(str(res.status_code), res.content.decode('utf-8', errors='replace'))
+
+    if res.status_code != 200:
+        code = root.find('.//sts:Error/sts:Code', NS)
+        message = root.find('.//sts:Error/sts:Message', NS)
+        raise Sts_error(code.text if code is not None else str(res.status_code),
+                        message.text if message is not None else '')
+
+    credentials = root.find('.//sts:Credentials', NS)
+    if credentials is None:
+        raise Sts_error(str(res.status_code), 'No credentials in response')
+
+    return {
+        'access_key_id': credentials.find('sts:AccessKeyId', NS).text,
+        'secret_access_key': credentials.find('sts:SecretAccessKey', NS).text,
+        'session_token': credentials.find('sts:SessionToken', NS).text,
+    }
+
+
+def _call(url, params, region=None, credentials=None):
+    body = urllib.parse.urlencode(sorted(params.items())).encode('utf-8')
+
+    def _f():
+        if credentials:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            headers = _sign(url, region, credentials, body, now)
+        else:
+            headers = {'content-type': CONTENT_TYPE}
+
+        try:
+            return (True, _parse_credentials(requests_retry.post(url, headers=headers, data=body)))
+        except Sts_error as exn:
+            return (False, exn)
+
+    def _test(ret):
+        success, v = ret
+        if not success and v.code in RETRYABLE_ERROR_CODES:
+            logging.error('STS : %s : RETRY : %s', params['Action'], v)
+            return False
+
+        return True
+
+    (success, v) = retry.run(
+        _f,
+        retry.finite_tries(TRIES, _test),
+        retry.betwixt_sleep_with_jitter(INITIAL_SLEEP, BACKOFF, MAX_SLEEP))
+
+    if not success:
+        raise v
+
+    return v
+
+
+def assume_role_with_web_identity(url, role_arn, session_name, web_identity_token, duration):
+    """Exchange [web_identity_token] for credentials for [role_arn].  Raises
+    [Sts_error] on failure.
+
+    """
+    return _call(url,
+                 {
+                     'Action': 'AssumeRoleWithWebIdentity',
+                     'Version': API_VERSION,
+                     'RoleArn': role_arn,
+                     'RoleSessionName': session_name,
+                     'WebIdentityToken': web_identity_token,
+                     'DurationSeconds': str(duration),
+                 })
+
+
+def assume_role(url, region, credentials, role_arn, session_name, duration):
+    """Use [credentials] to assume [role_arn].  Raises [Sts_error] on failure."""
+    return _call(url,
+                 {
+                     'Action': 'AssumeRole',
+                     'Version': API_VERSION,
+                     'RoleArn': role_arn,
+                     'RoleSessionName': session_name,
+                     'DurationSeconds': str(duration),
+                 },
+                 region=region,
+                 credentials=credentials)
@@ -0,0 +1,128 @@
+# Directories shared between dirspaces in a run.  If TERRATEAM_CACHE_DIR is set
+# to a persistent path, such as a volume on a self-hosted runner or a path saved
+# by an actions cache, they are also shared between runs.
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import threading
+
+import requests_retry
+
+
+CACHE_DIR_VAR = 'TERRATEAM_CACHE_DIR'
+
+ARCHS = {
+    'aarch64': 'arm64',
+    'amd64': 'amd64',
+    'arm64': 'arm64',
+    'x86_64': 'amd64',
+}
+
+
+def root(env):
+    return env.get(CACHE_DIR_VAR, os.path.join(tempfile.gettempdir(), 'terrateam-cache'))
+
+
+def target():
+    """Return the (os, arch) of this machine, as named by Terraform."""
+    machine = platform.machine().lower()
+    return (platform.system().lower(), ARCHS.get(machine, machine))
+
+
+@contextlib.contextmanager
+def lock(path, shared=False):
+    """Hold an flock on [path], creating it if needed, for the duration of the
+    context.  This works across processes, including other runs sharing the
+    cache.
+
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def size(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fname in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, fname)).st_size
+                except OSError:
+                    pass
+        return total
+    else:
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+
+
+def evict(entries, max_size):
+    """Given a list of cache entries, files or directories, remove the least
+    recently modified until their total size is at most [max_size] bytes.
+
+    """
+    sized = []
+    for entry in entries:
+        try:
+            sized.append((os.stat(entry).st_mtime, size(entry), entry))
+        except OSError:
+            pass
+
+    total = sum(s for _, s, _ in sized)
+    for _, entry_size, entry in sorted(sized):
+        if total <= max_size:
+            break
+
+        logging.info('CACHE : EVICT : %s : %d', entry, entry_size)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            try:
+                os.unlink(entry)
+            except FileNotFoundError:
+                pass
+
+        total -= entry_size
+
+
+def touch(path):
+    """Mark an entry as recently used, so it is evicted last."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def download(dest, url, shasum):
+    """Download [url] to [dest], which only appears once the download is
+    complete and its sha256 matches [shasum].
+
+    """
+    h = hashlib.sha256()
+    tmp_path = '{}.{}.{}.tmp'.format(dest, os.getpid(), threading.get_ident())
+    res = requests_retry.get(url, stream=True)
+    with res:
+        if res.status_code != 200:
+            raise Exception('Download failed: {}: {}'.format(url, res.status_code))
+
+        with open(tmp_path, 'wb') as f:
+            for chunk in res.iter_content(requests_retry.CHUNK_SIZE):
+                h.update(chunk)
+                f.write(chunk)
+
+    if h.hexdigest() != shasum:
+        os.unlink(tmp_path)
+        raise Exception('Checksum mismatch: {}'.format(url))
+
+    os.rename(tmp_path, dest)
@@ -1,17 +1,131 @@
+import codecs
 import io
 import logging
 import re
 import string
 import subprocess
 import sys
+import tempfile
+
+
+# Captured output is kept in memory until it is larger than this many
+# characters, then it is written to a file.
+OUTPUT_SPILL_THRESHOLD = 1024 * 1024
+
+READ_SIZE = 64 * 1024
+
+ANSI_ESCAPE = re.compile(r'\033\[(\d|;)+?m')
+
+# Matches an ANSI escape that is cut off at the end of a string.
+PARTIAL_ANSI_ESCAPE = re.compile(r'\033(\[[\d;]*)?$')
 
 
 class MissingEnvVar(Exception):
     pass
 
 
+class Output(object):
+    """The captured output of a command.  It is kept in memory until it passes
+    [threshold] characters and then it is moved to a file in [tmpdir].
+
+    """
+    def __init__(self, tmpdir=None, threshold=OUTPUT_SPILL_THRESHOLD):
+        self.tmpdir = tmpdir
+        self.threshold = threshold
+        self.size = 0
+        self._f = io.StringIO()
+        self._spilled = False
+
+    def __len__(self):
+        return self.size
+
+    def write(self, s):
+        self._f.write(s)
+        self.size += len(s)
+
+        if not self._spilled and self.size > self.threshold:
+            f = tempfile.TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)
+            f.write(self._f.getvalue())
+            self._f = f
+            self._spilled = True
+
+    def read(self, size=-1):
+        """Read up to [size] characters from the start of the output, or all of it if
+        [size] is negative.
+
+        """
+        self._f.seek(0)
+        try:
+            return self._f.read(size)
+        finally:
+            self._f.seek(0, io.SEEK_END)
+
+    def read_bounded(self, size, marker):
+        """Read the output if it is at most [size] characters, otherwise only its
+        first and last [size] / 2 characters with [marker] between them.  Only
+        that much of the output is ever in memory.
+
+        """
+        if self.size <= size:
+            return self.read()
+
+        half = size // 2
+        self._f.seek(0)
+        try:
+            head = self._f.read(half)
+            tail = ''
+            chunk = self._f.read(READ_SIZE)
+            while chunk:
+                tail = (tail + chunk)[-half:]
+                chunk = self._f.read(READ_SIZE)
+
+            return head + marker + tail
+        finally:
+            self._f.seek(0, io.SEEK_END)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def _strip_ansi(s):
-    return re.sub(r'\033\[(\d|;)+?m', '', s)
+    return ANSI_ESCAPE.sub('', s)
+
+
+def _strip_ansi_stream(chunks):
+    # An escape sequence can be split across chunks, so anything at the end of a
+    # chunk that could be the start of one is held back until the next chunk.
+    carry = ''
+    for chunk in chunks:
+        s = carry + chunk
+        m = PARTIAL_ANSI_ESCAPE.search(s)
+        if m:
+            carry = s[m.start():]
+            s = s[:m.start()]
+        else:
+            carry = ''
+
+        yield _strip_ansi(s)
+
+    yield carry
+
+
+def _read_output(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunk = stream.read1(READ_SIZE)
+    while chunk:
+        s = decoder.decode(chunk)
+        sys.stderr.write(s)
+        sys.stderr.flush()
+        yield s
+        chunk = stream.read1(READ_SIZE)
+
+    yield decoder.decode(b'', final=True)
 
 
 def _replace_vars(s, env):
@@ -28,16 +142,21 @@ def _create_env(env, additional_env):
     return env
 
 
-def run(state, config):
+def run(state, config, stdout=None):
     cmd = config['cmd']
     env = _create_env(state.env, config.get('env', {}))
     # Replace any variables in the cmd
     cmd = [_replace_vars(s, env) for s in cmd]
     logging.debug('CMD : cmd=%r : cwd=%s', cmd, state.working_dir)
-    return subprocess.run(cmd, cwd=state.working_dir, env=env)
+    return subprocess.run(cmd, cwd=state.working_dir, env=env, stdout=stdout)
 
 
-def run_with_output(state, config):
+def run_with_output_handle(state, config):
+    """Run the command, capturing its output with any ANSI escapes stripped, and
+    return the process and an [Output] handle.  The caller is responsible for
+    closing the handle.
+
+    """
     cmd = config['cmd']
     env = _create_env(state.env, config.get('env', {}))
     # Replace any variables in the cmd
@@ -49,14 +168,15 @@ def run_with_output(state, config):
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT)
 
-    line = proc.stdout.readline()
-    output = io.StringIO()
-    while line:
-        line = line.decode('utf-8')
-        output.write(line)
-        sys.stderr.write(line)
-        sys.stderr.flush()
-        line = proc.stdout.readline()
+    output = Output(tmpdir=env.get('TERRATEAM_TMPDIR'))
+    for s in _strip_ansi_stream(_read_output(proc.stdout)):
+        output.write(s)
 
     proc.wait()
-    return (proc, _strip_ansi(output.getvalue()))
+    return (proc, output)
+
+
+def run_with_output(state, config):
+    proc, output = run_with_output_handle(state, config)
+    with output:
+        return (proc, output.read())
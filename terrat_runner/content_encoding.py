@@ -0,0 +1,93 @@
+# Compression of request and response bodies.  gzip is always available, zstd
+# is used if the zstandard package is installed.
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP = 'gzip'
+IDENTITY = 'identity'
+ZSTD = 'zstd'
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def supported():
+    """Return the supported encodings, in order of preference, excluding
+    identity.
+
+    """
+    if zstandard:
+        return [ZSTD, GZIP]
+    else:
+        return [GZIP]
+
+
+def accept_encoding():
+    return ', '.join(supported() + [IDENTITY])
+
+
+def compress(encoding, chunks):
+    if encoding == GZIP:
+        c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == ZSTD:
+        c = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    elif encoding == IDENTITY:
+        yield from chunks
+        return
+    else:
+        raise Exception('Unknown content encoding: {}'.format(encoding))
+
+    for chunk in chunks:
+        out = c.compress(chunk)
+        if out:
+            yield out
+
+    yield c.flush()
+
+
+def decompress(encoding, chunks):
+    if encoding == GZIP:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == ZSTD and zstandard:
+        d = zstandard.ZstdDecompressor().decompressobj()
+    elif encoding in [None, '', IDENTITY]:
+        yield from chunks
+        return
+    else:
+        raise Exception('Unknown content encoding: {}'.format(encoding))
+
+    for chunk in chunks:
+        out = d.decompress(chunk)
+        if out:
+            yield out
+
+    if encoding == GZIP:
+        yield d.flush()
+
+
+class Encoded_body(object):
+    """A request body which is the encoding of another iterable body.  The
+    length of the encoded body is not known up front, so it is sent chunked.
+
+    """
+    def __init__(self, encoding, body):
+        self.encoding = encoding
+        self.body = body
+
+    def __iter__(self):
+        return compress(self.encoding, iter(self.body))
+
+
+def response_chunks(res, chunk_size):
+    """Iterate the decoded body of a streamed response, decoding any content
+    encoding ourselves so that it does not depend on what the installed
+    urllib3 supports.
+
+    """
+    return decompress(res.headers.get('content-encoding'),
+                      res.raw.stream(chunk_size, decode_content=False))
@@ -1,57 +1,125 @@
+import collections
+import logging
 import multiprocessing
+import multiprocessing.pool
+import queue
+
+import resources
+
+
+# How often to re-check if more dirspaces can be started while waiting on
+# running ones to finish.
+POLL_INTERVAL = 1
 
 
 # Need to order dirs by rank, but also, want to run one workspace at a time for
-# a dir.  So we fake it by increasing the rank on dirs that have multiple
-# workspaces.
-def _order_dirs_by_rank(dirs):
+# a dir.  Ranks are run strictly one after the other, but within a rank any
+# dirspace can be started as soon as there is a free worker, as long as no other
+# workspace of the same path is currently running.
+def _group_by_rank(dirs):
     ranking = {}
 
     for d in dirs:
-        ranking.setdefault(d['rank'], {}).setdefault(d['path'], []).append(d)
+        (ranking
+         .setdefault(d['rank'], collections.OrderedDict())
+         .setdefault(d['path'], collections.deque())
+         .append(d))
 
     # ranking is a dict where the key is the numerical rank and the value is a
-    # dictionary of the dir path to all entries.  There will only be multiple
-    # entries for the path if there are multiple workspaces.
-    #
-    # We iterate the ranking, in order, and then for each list of values, we
-    # consume any dirspaces that we can and at the end of each iteration add the
-    # row to the final result.  Once there are no more values to add, then
-    # [added] will be false, and we exit.
+    # dictionary of the dir path to the queue of its dirspaces.  There will only
+    # be multiple entries for the path if there are multiple workspaces.
     #
     # For example, if we have dirs [(1, d1, w1), (1, d1, w2), (2, d2,w1)]
     #
-    # ranking would be {1: {d1: [(1, d1, w1), (1, d1, w2)]}, 2: [(2, d2, w1)]}
-    #
-    # Then the result would be [[(1, d1, w1)], [(1, d1, w2)], [(2, d2, w1)]]
-    ret = []
-    for k in sorted(ranking.keys()):
-        row = []
-        vs = ranking[k].values()
+    # The result would be [{d1: [(1, d1, w1), (1, d1, w2)]}, {d2: [(2, d2, w1)]}]
+    return [ranking[k] for k in sorted(ranking.keys())]
 
-        added = True
-        while added:
-            added = False
-            for v in vs:
-                if v:
-                    row.append(v.pop())
-                    added = True
 
-            ret.append(row)
-            row = []
+# The function and arguments shared by every dirspace in a run.  These are
+# handed to each worker once, when it starts, so that a task only has to carry
+# its dirspace.
+_context = None
 
-    return ret
 
+def _init_worker(f, args):
+    global _context
+    _context = (f, args)
 
-def _run(args):
-    return args[0](*args[1:])
 
+def _run(d):
+    f, args = _context
+    ret = f(*(args + (d,)))
+    return (resources.children_peak_rss(), ret)
 
-def run(parallel, dirs, f, args):
-    dirs = _order_dirs_by_rank(dirs)
+
+def _submit(pool, done, path, d):
+    # The callbacks are executed in the pool's result handler thread, so all
+    # they do is hand the result back to the scheduler.
+    pool.apply_async(_run,
+                     (d,),
+                     callback=lambda ret: done.put((path, True, ret)),
+                     error_callback=lambda exn: done.put((path, False, exn)))
+
+
+def _run_rank(pool, limiter, paths):
+    done = queue.Queue()
+    # The set of paths which currently have a workspace executing.  A path is
+    # only ever in here once, which is what gives us one workspace at a time per
+    # dir.
+    running = set()
     res = []
-    for ds in dirs:
-        with multiprocessing.Pool(parallel) as p:
-            res.extend(p.map(_run, [(f,) + args + (d,) for d in ds]))
+
+    def _start_ready():
+        for path, ds in paths.items():
+            if ds and path not in running and limiter.can_start(len(running)):
+                running.add(path)
+                limiter.started()
+                _submit(pool, done, path, ds.popleft())
+
+    _start_ready()
+
+    while running:
+        try:
+            path, success, ret = done.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            # Nothing finished, but resources may have been freed up.
+            _start_ready()
+            continue
+
+        running.remove(path)
+
+        if not success:
+            raise ret
+
+        peak_rss, ret = ret
+        limiter.update_peak_rss(peak_rss)
+        res.append(ret)
+        _start_ready()
+
+    return res
+
+
+def _run_pool(pool_cls, parallel, dirs, f, args):
+    limiter = resources.Limiter(parallel)
+    logging.debug('DIR_EXEC : PARALLEL : %r : max=%d', parallel, limiter.max_parallel())
+    res = []
+    with pool_cls(limiter.max_parallel(),
+                  initializer=_init_worker,
+                  initargs=(f, args)) as p:
+        for paths in _group_by_rank(dirs):
+            res.extend(_run_rank(p, limiter, paths))
 
     return res
+
+
+def run(parallel, dirs, f, args):
+    return _run_pool(multiprocessing.Pool, parallel, dirs, f, args)
+
+
+# Executing a dirspace is almost entirely waiting on child processes, which
+# releases the GIL, so the dirspaces can just as well be run on threads of this
+# process rather than in their own Python process.  The scheduling is the same,
+# as a thread pool has the same API as a process pool.  The peak RSS of children
+# is per process, so it covers the children of every thread.
+def run_thread(parallel, dirs, f, args):
+    return _run_pool(multiprocessing.pool.ThreadPool, parallel, dirs, f, args)
@@ -6,6 +6,7 @@ import workflow_step
 ALLOWED_HOOK_STEPS = [
     'drift_create_issue',
     'env',
+    'infracost_plan_json',
     'infracost_setup',
     'oidc',
     'run',
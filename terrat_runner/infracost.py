@@ -26,18 +26,23 @@ def create_infracost_yml(outname, dirspaces):
     for ds in dirspaces:
         by_workspace.setdefault(ds['workspace'], []).append(ds)
 
+    # Sorted so that the same dirspaces always give the same config, the base
+    # breakdown is cached by its contents.
     dirspaces = []
-    for ws, dspaces in by_workspace.items():
-        ds = set([d['path'].split('/')[0] for d in dspaces])
+    for ws, dspaces in sorted(by_workspace.items()):
+        ds = sorted(set([d['path'].split('/')[0] for d in dspaces]))
         if '.' in ds:
             dirspaces.append({'path': '.', 'workspace': ws})
         else:
             dirspaces.extend([{'path': d, 'workspace': ws} for d in ds])
 
+    # Projects are named explicitly so that they match between breakdowns run in
+    # different checkouts of the repo.
     config = {
         'version': '0.1',
         'projects': [
             {
+                'name': '{}:{}'.format(ds['path'], ds['workspace']),
                 'path': ds['path'],
                 'terraform_workspace': ds['workspace'],
             }
@@ -47,3 +52,24 @@ def create_infracost_yml(outname, dirspaces):
 
     with open(outname, 'w') as f:
         yaml.dump(config, f)
+
+
+def create_plan_json_infracost_yml(outname, plan_jsons):
+    """Create an infracost config with a project per (dirspace, plan JSON path)
+    in [plan_jsons].
+
+    """
+    config = {
+        'version': '0.1',
+        'projects': [
+            {
+                'name': '{}:{}'.format(ds['path'], ds['workspace']),
+                'path': plan_json,
+                'terraform_workspace': ds['workspace'],
+            }
+            for ds, plan_json in plan_jsons
+        ]
+    }
+
+    with open(outname, 'w') as f:
+        yaml.dump(config, f)
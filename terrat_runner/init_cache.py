@@ -0,0 +1,323 @@
+# A persisted TF_DATA_DIR per dirspace, reused by an init when nothing that
+# affects the init has changed.  The inputs to an init are fingerprinted: the
+# Terraform version, the dependency lock file, the terraform blocks (backend,
+# cloud, required providers), the source and version of every module, and the
+# init arguments.  If the fingerprint matches the one the data dir was saved
+# with, the init only has to re-check the backend and installed providers,
+# rather than start from scratch.
+#
+# Modules are not installed again when the data dir is reused, so a dirspace
+# with a remote module that is not pinned to an exact version or commit, which
+# could resolve to something new on every init, is never cached.  The backend
+# state file, which holds the backend configuration and so possibly
+# credentials, is not saved.
+#
+# The data dir is copied into the dirspace's tmpdir for the run and copied back
+# after a successful init, so concurrent runs never share a data dir.  Installed
+# modules are recorded in the data dir by absolute path, so those paths are
+# rewritten to the new location when it is restored.
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+
+import cache
+import repo_config as rc
+
+
+DATA_DIR_VAR = 'TF_DATA_DIR'
+
+FINGERPRINT_FILE = '.terrateam-fingerprint'
+
+# The path the data dir was at when it was saved.
+DATA_DIR_FILE = '.terrateam-data-dir'
+
+MODULES_MANIFEST = os.path.join('modules', 'modules.json')
+
+LOCK_FILE = '.terraform.lock.hcl'
+
+# Environment variables that change what an init does.
+ENV_VARS = ['TERRATEAM_TERRAFORM_VERSION', 'TF_WORKSPACE', 'TF_CLI_ARGS', 'TF_CLI_ARGS_init']
+
+# The start of a top-level block whose contents affect an init.
+BLOCK_START = re.compile(r'^(terraform|module\s+"[^"]*")\s*\{', re.MULTILINE)
+
+MODULE_ATTR = re.compile(r'^\s*(source|version)\s*=.*$', re.MULTILINE)
+
+LOCAL_MODULE_SOURCE = re.compile(r'^\s*source\s*=\s*"(\.\.?/[^"]*)"', re.MULTILINE)
+
+MODULE_SOURCE = re.compile(r'^\s*source\s*=\s*"([^"]*)"', re.MULTILINE)
+
+MODULE_VERSION = re.compile(r'^\s*version\s*=\s*"([^"]*)"', re.MULTILINE)
+
+VCS_MODULE_SOURCE = re.compile(r'^(git::|hg::|github\.com/|bitbucket\.org/|git@)')
+
+# Any other source with a scheme or forced getter, such as an archive over
+# HTTP or in a bucket, can change without its source changing.
+URL_MODULE_SOURCE = re.compile(r'^(\w+::|\w+://)')
+
+REF_PARAM = re.compile(r'[?&]ref=([^&]+)')
+
+COMMIT_REF = re.compile(r'^[0-9a-f]{40}$')
+
+EXACT_VERSION = re.compile(r'^=?\s*v?\d+(\.\d+)*(-[0-9A-Za-z.-]+)?$')
+
+# Written by the init to the data dir, it holds the backend configuration.
+BACKEND_STATE_FILE = 'terraform.tfstate'
+
+BACKEND_CONFIG_ARG = '-backend-config='
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return b''
+
+
+def _blocks(content):
+    # Brace matching does not understand strings or heredocs, but the blocks we
+    # care about rarely have either.  If the braces do not balance, the rest of
+    # the file is used, so a change is never missed.
+    for m in BLOCK_START.finditer(content):
+        depth = 0
+        for idx in range(m.end() - 1, len(content)):
+            if content[idx] == '{':
+                depth += 1
+            elif content[idx] == '}':
+                depth -= 1
+                if depth == 0:
+                    yield (m.group(1), content[m.start():idx + 1])
+                    break
+        else:
+            yield (m.group(1), content[m.start():])
+
+
+def _pinned(source, version):
+    if source.startswith('./') or source.startswith('../'):
+        return True
+    elif VCS_MODULE_SOURCE.match(source):
+        ref = REF_PARAM.search(source)
+        return bool(ref and (COMMIT_REF.match(ref.group(1)) or EXACT_VERSION.match(ref.group(1))))
+    elif URL_MODULE_SOURCE.match(source):
+        return False
+    else:
+        # A registry module, which resolves its version constraint on every init.
+        return bool(version and EXACT_VERSION.match(version.strip()))
+
+
+def _json_modules(content):
+    try:
+        modules = json.loads(content).get('module', {})
+    except (ValueError, AttributeError):
+        return []
+
+    ret = []
+    for module in (modules if isinstance(modules, list) else [modules]):
+        for body in (module.values() if isinstance(module, dict) else []):
+            for b in (body if isinstance(body, list) else [body]):
+                if isinstance(b, dict):
+                    ret.append((b.get('source', ''), b.get('version')))
+
+    return ret
+
+
+def _fingerprint_dir(h, path, seen, unpinned):
+    path = os.path.realpath(path)
+    if path in seen:
+        return
+
+    seen.add(path)
+
+    for fname in sorted(glob.glob(os.path.join(path, '*.tf.json'))):
+        content = _read(fname)
+        h.update(fname.encode('utf-8'))
+        h.update(content)
+
+        for source, version in _json_modules(content):
+            if not _pinned(source, version):
+                unpinned.append(source)
+            elif source.startswith('./') or source.startswith('../'):
+                _fingerprint_dir(h, os.path.join(path, source), seen, unpinned)
+
+    for fname in sorted(glob.glob(os.path.join(path, '*.tf'))):
+        content = _read(fname).decode('utf-8', errors='replace')
+        for name, block in _blocks(content):
+            if name == 'terraform':
+                h.update(block.encode('utf-8'))
+            else:
+                h.update(name.encode('utf-8'))
+                # Only where a module comes from matters to an init, not the
+                # inputs given to it.
+                for attr in MODULE_ATTR.finditer(block):
+                    h.update(attr.group(0).strip().encode('utf-8'))
+
+                source = MODULE_SOURCE.search(block)
+                version = MODULE_VERSION.search(block)
+                if not source or not _pinned(source.group(1), version and version.group(1)):
+                    unpinned.append(source.group(1) if source else name)
+
+                # A local module is read in place, but any modules it calls
+                # have to be installed.
+                for source in LOCAL_MODULE_SOURCE.finditer(block):
+                    _fingerprint_dir(h, os.path.join(path, source.group(1)), seen, unpinned)
+
+
+def fingerprint(state, config):
+    """Return the fingerprint of the inputs to the init of [state], or None if
+    its data dir cannot be reused.
+
+    """
+    h = hashlib.sha256()
+
+    for var in ENV_VARS:
+        h.update('{}={}\n'.format(var, state.env.get(var, '')).encode('utf-8'))
+
+    for arg in config.get('extra_args', []):
+        h.update(arg.encode('utf-8'))
+        if arg.startswith(BACKEND_CONFIG_ARG):
+            h.update(_read(os.path.join(state.working_dir, arg[len(BACKEND_CONFIG_ARG):])))
+
+    h.update(_read(os.path.join(state.working_dir, LOCK_FILE)))
+
+    unpinned = []
+    _fingerprint_dir(h, state.working_dir, set(), unpinned)
+
+    if unpinned:
+        logging.info('INIT_CACHE : UNPINNED_MODULES : %s : %s : %s',
+                     state.path,
+                     state.workspace,
+                     ', '.join(sorted(set(unpinned))))
+        return None
+
+    return h.hexdigest()
+
+
+def _root(state, config):
+    return os.path.expanduser(config['path'] or os.path.join(cache.root(state.env), 'init'))
+
+
+def _key(state):
+    h = hashlib.sha256()
+    h.update(state.env.get('GITHUB_REPOSITORY', '').encode('utf-8'))
+    h.update(b'\0')
+    h.update(state.path.encode('utf-8'))
+    h.update(b'\0')
+    h.update(state.workspace.encode('utf-8'))
+    return h.hexdigest()
+
+
+def enabled(state):
+    if not rc.get_init_cache(state.repo_config)['enabled']:
+        return False
+    elif state.workflow['terragrunt'] or state.workflow['cdktf']:
+        # Both manage where terraform is run from themselves.
+        return False
+    elif DATA_DIR_VAR in state.env:
+        # Already configured by the user, so leave it be.
+        return False
+    else:
+        return True
+
+
+def _relocate_modules(data_dir, saved_data_dir):
+    if not saved_data_dir:
+        raise ValueError('No {} in saved data dir'.format(DATA_DIR_FILE))
+
+    manifest_path = os.path.join(data_dir, MODULES_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    for module in manifest.get('Modules', []):
+        module_dir = module.get('Dir', '')
+        if module_dir == saved_data_dir or module_dir.startswith(saved_data_dir + os.sep):
+            module['Dir'] = data_dir + module_dir[len(saved_data_dir):]
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def restore(state, fp):
+    """Copy the saved data dir for the dirspace of [state] into its tmpdir and set
+    TF_DATA_DIR to it.  Returns the updated state and whether the saved data
+    dir matched the fingerprint [fp].
+
+    """
+    config = rc.get_init_cache(state.repo_config)
+    saved = os.path.join(_root(state, config), _key(state))
+    data_dir = os.path.join(state.env['TERRATEAM_TMPDIR'], 'tf-data')
+
+    env = state.env.copy()
+    env[DATA_DIR_VAR] = data_dir
+    state = state._replace(env=env)
+
+    with cache.lock(saved + '.lock', shared=True):
+        if _read(os.path.join(saved, FINGERPRINT_FILE)).decode('utf-8') != fp:
+            logging.info('INIT_CACHE : MISS : %s : %s', state.path, state.workspace)
+            return (state, False)
+
+        try:
+            shutil.copytree(saved, data_dir, symlinks=True)
+            _relocate_modules(data_dir, _read(os.path.join(saved, DATA_DIR_FILE)).decode('utf-8'))
+        except (OSError, ValueError, shutil.Error) as exn:
+            logging.warning('INIT_CACHE : RESTORE_FAILED : %s : %s : %s',
+                            state.path,
+                            state.workspace,
+                            exn)
+            shutil.rmtree(data_dir, ignore_errors=True)
+            return (state, False)
+
+    cache.touch(saved)
+    logging.info('INIT_CACHE : HIT : %s : %s', state.path, state.workspace)
+    return (state, True)
+
+
+def save(state, fp):
+    """Save the data dir of [state] with the fingerprint [fp], evicting old data
+    dirs if the cache has grown past its maximum size.
+
+    """
+    config = rc.get_init_cache(state.repo_config)
+    root = _root(state, config)
+    saved = os.path.join(root, _key(state))
+    tmp = '{}.tmp.{}'.format(saved, os.getpid())
+    data_dir = state.env[DATA_DIR_VAR]
+
+    if not os.path.isdir(data_dir):
+        return
+
+    try:
+        shutil.copytree(data_dir,
+                        tmp,
+                        symlinks=True,
+                        ignore=lambda d, names: [BACKEND_STATE_FILE] if d == data_dir else [])
+        with open(os.path.join(tmp, FINGERPRINT_FILE), 'w') as f:
+            f.write(fp)
+
+        with open(os.path.join(tmp, DATA_DIR_FILE), 'w') as f:
+            f.write(data_dir)
+
+        with cache.lock(saved + '.lock'):
+            shutil.rmtree(saved, ignore_errors=True)
+            os.rename(tmp, saved)
+    except (OSError, shutil.Error) as exn:
+        logging.warning('INIT_CACHE : SAVE_FAILED : %s : %s : %s',
+                        state.path,
+                        state.workspace,
+                        exn)
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    logging.info('INIT_CACHE : SAVED : %s : %s', state.path, state.workspace)
+
+    cache.evict([entry
+                 for entry in glob.glob(os.path.join(root, '*'))
+                 if os.path.isdir(entry) and '.tmp.' not in entry],
+                config['max_size_mb'] * 1024 * 1024)
@@ -0,0 +1,31 @@
+# Reading the providers out of a Terraform dependency lock file.
+import os
+import re
+
+
+LOCK_FILE = '.terraform.lock.hcl'
+
+PROVIDER_BLOCK = re.compile(r'provider\s+"([^"]+)"\s*\{([^}]*)\}')
+PROVIDER_VERSION = re.compile(r'^\s*version\s*=\s*"([^"]+)"', re.MULTILINE)
+
+
+def path(working_dir):
+    return os.path.join(working_dir, LOCK_FILE)
+
+
+def parse(path):
+    """Return the list of (hostname, namespace, type, version) of the providers
+    in a dependency lock file.
+
+    """
+    with open(path) as f:
+        content = f.read()
+
+    ret = []
+    for m in PROVIDER_BLOCK.finditer(content):
+        source = m.group(1).split('/')
+        version = PROVIDER_VERSION.search(m.group(2))
+        if len(source) == 3 and version:
+            ret.append((source[0], source[1], source[2], version.group(1)))
+
+    return ret
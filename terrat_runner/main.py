@@ -5,6 +5,7 @@ import os
 import subprocess
 
 import repo_config
+import requests_retry
 import run_state
 import work_apply
 import work_exec
@@ -196,6 +197,9 @@ def main():
     logging.debug('LOADING: REPO_CONFIG')
     rc = repo_config.load([os.path.join(args.workspace, path) for path in REPO_CONFIG_PATHS])
 
+    http_config = repo_config.get_http(rc)
+    requests_retry.configure(http_config['pool_connections'], http_config['pool_maxsize'])
+
     run_time = github_actions.run_time.Run_time()
 
     run_time.set_secret(wm['token'])
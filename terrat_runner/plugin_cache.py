@@ -0,0 +1,154 @@
+# A Terraform provider plugin cache shared by every dirspace.  Terraform
+# only uses a cached provider if it matches the checksums in the dirspace's
+# dependency lock file, so the cache never changes which providers are used.
+#
+# Terraform does not lock the cache while installing providers into it, so an
+# init that may install into the cache holds its lock exclusively.  An init
+# whose providers are all in the cache only reads from it and holds the lock
+# shared, so those run concurrently.
+#
+# The cache is opt-in.  On a runner which does not keep TERRATEAM_CACHE_DIR
+# between runs the cache starts empty, so the first inits to install a
+# provider run one at a time.
+import contextlib
+import fcntl
+import glob
+import logging
+import os
+import shutil
+import zipfile
+
+import cache
+import lock_file
+import repo_config as rc
+
+
+PLUGIN_CACHE_DIR_VAR = 'TF_PLUGIN_CACHE_DIR'
+
+
+def _entries(path):
+    # The cache layout is <hostname>/<namespace>/<type>/<version>/<os>_<arch>,
+    # entries are evicted a version at a time.
+    return glob.glob(os.path.join(path, '*', '*', '*', '*'))
+
+
+def _lock_path(path):
+    return os.path.join(path, '.lock')
+
+
+def _provider_path(path, provider, target):
+    hostname, namespace, type_, version = provider
+    return os.path.join(path, hostname, namespace, type_, version, '{}_{}'.format(*target))
+
+
+def _all_cached(path, working_dir):
+    target = cache.target()
+    return all(os.path.isdir(_provider_path(path, provider, target))
+               for provider in lock_file.parse(lock_file.path(working_dir)))
+
+
+def _unpack(package, dest):
+    tmp = '{}.tmp.{}'.format(dest, os.getpid())
+    try:
+        with zipfile.ZipFile(package) as z:
+            for info in z.infolist():
+                extracted = z.extract(info, tmp)
+                # Provider binaries must stay executable.
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(extracted, mode)
+
+        os.rename(tmp, dest)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def setup(state):
+    """Add the plugin cache to the env of [state], if it is enabled, evicting
+    entries if it has grown past its maximum size.
+
+    """
+    config = rc.get_plugin_cache(state.repo_config)
+
+    if not config['enabled']:
+        return state
+
+    if PLUGIN_CACHE_DIR_VAR in state.env:
+        # Already configured by the user, so leave it be.  Inits will still lock it.
+        logging.info('PLUGIN_CACHE : USER_CONFIGURED : %s', state.env[PLUGIN_CACHE_DIR_VAR])
+        return state
+
+    path = config['path'] or os.path.join(cache.root(state.env), 'plugins')
+    path = os.path.expanduser(path)
+    os.makedirs(path, exist_ok=True)
+
+    logging.info('PLUGIN_CACHE : %s', path)
+
+    with cache.lock(_lock_path(path)):
+        cache.evict(_entries(path), config['max_size_mb'] * 1024 * 1024)
+
+    env = state.env.copy()
+    env[PLUGIN_CACHE_DIR_VAR] = path
+    return state._replace(env=env)
+
+
+def populate(env, packages):
+    """Unpack provider [packages], a list of (provider, zip path), into the plugin
+    cache, if it is enabled, skipping those already in it.
+
+    """
+    path = env.get(PLUGIN_CACHE_DIR_VAR)
+    if not path:
+        return
+
+    target = cache.target()
+    with cache.lock(_lock_path(path)):
+        for provider, package in packages:
+            dest = _provider_path(path, provider, target)
+            if os.path.isdir(dest):
+                continue
+
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                _unpack(package, dest)
+                logging.debug('PLUGIN_CACHE : POPULATED : %s', dest)
+            except Exception as exn:
+                # Not fatal, the init will install it itself.
+                logging.warning('PLUGIN_CACHE : POPULATE_FAILED : %s : %s', dest, exn)
+
+
+@contextlib.contextmanager
+def lock(state):
+    """Hold the cache lock for the duration of an init of [state], yielding the
+    state to run the init with.  The lock is shared if every provider in the
+    dependency lock file is already in the cache, otherwise exclusive.  A dir
+    without a lock file does not use the cache at all, rather than hold the
+    lock exclusively for an init that could install anything.
+
+    """
+    path = state.env.get(PLUGIN_CACHE_DIR_VAR)
+    if not path:
+        yield state
+        return
+
+    if not os.path.exists(lock_file.path(state.working_dir)):
+        logging.info('PLUGIN_CACHE : NO_LOCK_FILE : %s', state.working_dir)
+        env = state.env.copy()
+        del env[PLUGIN_CACHE_DIR_VAR]
+        yield state._replace(env=env)
+        return
+
+    os.makedirs(path, exist_ok=True)
+    with open(_lock_path(path), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        if not _all_cached(path, state.working_dir):
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Another init may have installed them while we waited.
+            if _all_cached(path, state.working_dir):
+                fcntl.flock(f, fcntl.LOCK_SH)
+
+        try:
+            yield state
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
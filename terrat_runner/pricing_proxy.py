@@ -0,0 +1,183 @@
+# A caching proxy for the infracost pricing API, run on localhost for the
+# duration of an infracost step.  infracost makes the same pricing queries for
+# the same resources in every dirspace and every run, so successful responses
+# are cached on disk, keyed by the query, for a limited time.  Batched queries
+# are cached a query at a time.  With a persistent TERRATEAM_CACHE_DIR the cache
+# is shared between runs.
+import contextlib
+import glob
+import hashlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+import cache
+import requests_retry
+
+
+PRICING_API_ENDPOINT_VAR = 'INFRACOST_PRICING_API_ENDPOINT'
+
+PUBLIC_PRICING_API_ENDPOINT = 'https://pricing.api.infracost.io'
+
+# Request headers which are about the connection to the proxy, not the query,
+# and are not forwarded.
+HOP_HEADERS = ['accept-encoding', 'connection', 'content-length', 'host']
+
+
+def _cache_path(cache_dir, upstream, path, query):
+    # The API key is not part of the key, prices do not depend on who asks.
+    h = hashlib.sha256()
+    h.update(upstream.encode('utf-8'))
+    h.update(b'\0')
+    h.update(path.encode('utf-8'))
+    h.update(b'\0')
+    h.update(json.dumps(query, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, h.hexdigest() + '.json')
+
+
+def _load(cached, ttl):
+    try:
+        if time.time() - os.stat(cached).st_mtime > ttl:
+            return None
+
+        with open(cached, 'rb') as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save(cached, result):
+    # Only cache answers, a GraphQL error is also a 200.
+    if not isinstance(result, dict) or result.get('errors'):
+        return
+
+    tmp_path = '{}.{}.{}.tmp'.format(cached, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f)
+
+    os.rename(tmp_path, cached)
+
+
+def _make_handler(upstream, cache_dir, ttl):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _respond(self, status_code, body, content_type='application/json'):
+            self.send_response(status_code)
+            self.send_header('content-type', content_type)
+            self.send_header('content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _respond_upstream(self, res):
+            if res is None:
+                self._respond(502, b'')
+            else:
+                self._respond(res.status_code,
+                              res.content,
+                              res.headers.get('content-type', 'application/json'))
+
+        def _upstream(self, method, body):
+            headers = {k: v
+                       for k, v in self.headers.items()
+                       if k.lower() not in HOP_HEADERS}
+            try:
+                return requests_retry.request(method,
+                                              upstream + self.path,
+                                              headers=headers,
+                                              data=body)
+            except Exception as exn:
+                logging.error('PRICING_PROXY : UPSTREAM_FAILED : %s : %s', self.path, exn)
+                return None
+
+        def do_GET(self):
+            self._respond_upstream(self._upstream('GET', None))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('content-length', 0)))
+
+            try:
+                queries = json.loads(body)
+            except ValueError:
+                self._respond_upstream(self._upstream('POST', body))
+                return
+
+            # infracost batches its queries into an array, each query is cached
+            # on its own and only those not in the cache are sent upstream.
+            batched = isinstance(queries, list)
+            if not batched:
+                queries = [queries]
+
+            paths = [_cache_path(cache_dir, upstream, self.path, query) for query in queries]
+            results = [_load(path, ttl) for path in paths]
+            misses = [idx for idx, result in enumerate(results) if result is None]
+
+            logging.debug('PRICING_PROXY : QUERIES : hits=%d : misses=%d',
+                          len(queries) - len(misses),
+                          len(misses))
+
+            for path, result in zip(paths, results):
+                if result is not None:
+                    cache.touch(path)
+
+            if misses:
+                if batched:
+                    upstream_body = [queries[idx] for idx in misses]
+                else:
+                    upstream_body = queries[0]
+
+                res = self._upstream('POST', json.dumps(upstream_body).encode('utf-8'))
+
+                try:
+                    answers = res.json() if res is not None and res.status_code == 200 else None
+                except ValueError:
+                    answers = None
+
+                if not batched:
+                    answers = [answers]
+
+                if not isinstance(answers, list) or len(answers) != len(misses) or None in answers:
+                    self._respond_upstream(res)
+                    return
+
+                for idx, answer in zip(misses, answers):
+                    results[idx] = answer
+                    _save(paths[idx], answer)
+
+            self._respond(200, json.dumps(results if batched else results[0]).encode('utf-8'))
+
+        def log_message(self, fmt, *args):
+            logging.debug('PRICING_PROXY : ' + fmt, *args)
+
+    return Handler
+
+
+@contextlib.contextmanager
+def running(upstream, cache_dir, ttl, max_size):
+    """Run the proxy in front of the pricing API at [upstream] for the duration
+    of the context, yielding its endpoint.  Responses are cached in [cache_dir]
+    for [ttl] seconds, and the cache is evicted down to [max_size] bytes when
+    the proxy is stopped.
+
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             _make_handler(upstream.rstrip('/'), cache_dir, ttl))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    endpoint = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    logging.info('PRICING_PROXY : START : %s : %s', endpoint, upstream)
+
+    try:
+        yield endpoint
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        cache.evict(glob.glob(os.path.join(cache_dir, '*.json')), max_size)
+        logging.info('PRICING_PROXY : STOP')
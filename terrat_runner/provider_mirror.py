@@ -0,0 +1,189 @@
+# Before any dirspace is executed, every provider in the dependency lock files
+# of the changed dirs is downloaded once, in parallel, into a filesystem mirror.
+# Every init then installs providers from the mirror rather than each one
+# downloading them itself.  The mirror is listed before direct installation in
+# the CLI configuration, so anything that is not in the mirror is still
+# installed from its registry.
+#
+# The mirror is opt-in.  The CLI configuration Terraform is pointed at is a copy
+# of the user's, taken after the pre hooks, so any CLI configuration written
+# after that, for example credentials written by a run step of a workflow, is
+# not seen by Terraform.
+import contextlib
+import glob
+import logging
+import multiprocessing.pool
+import os
+import urllib.parse
+
+import cache
+import lock_file
+import plugin_cache
+import repo_config as rc
+import requests_retry
+
+
+CLI_CONFIG_FILE_VAR = 'TF_CLI_CONFIG_FILE'
+
+MIRROR_DIR_VAR = 'TERRATEAM_PROVIDER_MIRROR_DIR'
+
+
+CLI_CONFIG = '''
+provider_installation {{
+  filesystem_mirror {{
+    path = "{path}"
+  }}
+  direct {{}}
+}}
+'''
+
+
+def _mirror_path(mirror_dir, provider, target):
+    hostname, namespace, type_, version = provider
+    os_, arch = target
+    return os.path.join(mirror_dir,
+                        hostname,
+                        namespace,
+                        type_,
+                        'terraform-provider-{}_{}_{}_{}.zip'.format(type_, version, os_, arch))
+
+
+def _providers_url(hostname):
+    res = requests_retry.get('https://{}/.well-known/terraform.json'.format(hostname))
+    if res.status_code != 200:
+        raise Exception('Service discovery failed for {}: {}'.format(hostname, res.status_code))
+
+    return urllib.parse.urljoin('https://{}/'.format(hostname), res.json()['providers.v1'])
+
+
+def _fetch_provider(mirror_dir, providers_urls, target, provider):
+    hostname, namespace, type_, version = provider
+    dest = _mirror_path(mirror_dir, provider, target)
+
+    if os.path.exists(dest):
+        logging.debug('PROVIDER_MIRROR : HIT : %s', dest)
+        cache.touch(dest)
+        return True
+
+    try:
+        if hostname not in providers_urls:
+            providers_urls[hostname] = _providers_url(hostname)
+
+        url = urllib.parse.urljoin(providers_urls[hostname],
+                                   '{}/{}/{}/download/{}/{}'.format(namespace,
+                                                                    type_,
+                                                                    version,
+                                                                    target[0],
+                                                                    target[1]))
+        res = requests_retry.get(url)
+        if res.status_code != 200:
+            raise Exception('Could not find package: {}: {}'.format(url, res.status_code))
+
+        package = res.json()
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        cache.download(dest, urllib.parse.urljoin(url, package['download_url']), package['shasum'])
+
+        logging.info('PROVIDER_MIRROR : FETCHED : %s', dest)
+        return True
+    except Exception as exn:
+        logging.error('PROVIDER_MIRROR : FAIL : %s/%s/%s %s : %s',
+                      hostname,
+                      namespace,
+                      type_,
+                      version,
+                      exn)
+        return False
+
+
+def _lock_path(mirror_dir):
+    return os.path.join(mirror_dir, '.lock')
+
+
+def _read_cli_config(env):
+    path = env.get(CLI_CONFIG_FILE_VAR, os.path.expanduser(os.path.join('~', '.terraformrc')))
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read()
+    else:
+        return ''
+
+
+def setup(state):
+    """Fetch the providers of every changed dir into the mirror and configure
+    Terraform to use it, returning the new state.
+
+    """
+    config = rc.get_provider_mirror(state.repo_config)
+
+    if not config['enabled']:
+        return state
+
+    cli_config = _read_cli_config(state.env)
+    if 'provider_installation' in cli_config:
+        # We cannot safely combine our configuration with the user's own.
+        logging.info('PROVIDER_MIRROR : USER_CONFIGURED')
+        return state
+
+    mirror_dir = os.path.expanduser(config['path']
+                                    or os.path.join(cache.root(state.env), 'providers'))
+
+    providers = set()
+    for path in set(d['path'] for d in state.work_manifest['changed_dirspaces']):
+        lock_file_path = lock_file.path(os.path.join(state.working_dir, path))
+        if os.path.exists(lock_file_path):
+            providers.update(lock_file.parse(lock_file_path))
+
+    logging.info('PROVIDER_MIRROR : %s : providers=%d', mirror_dir, len(providers))
+
+    if not providers:
+        return state
+
+    machine = cache.target()
+    providers_urls = {}
+    with cache.lock(_lock_path(mirror_dir), shared=True):
+        with multiprocessing.pool.ThreadPool(config['parallelism']) as p:
+            fetched = p.map(lambda provider: _fetch_provider(mirror_dir,
+                                                             providers_urls,
+                                                             machine,
+                                                             provider),
+                            sorted(providers))
+
+        logging.info('PROVIDER_MIRROR : FETCHED : %d/%d', sum(fetched), len(providers))
+
+        # Unpacked into the plugin cache up front, so that inits find every
+        # provider there and do not have to hold the plugin cache lock exclusively.
+        plugin_cache.populate(state.env,
+                              [(provider, _mirror_path(mirror_dir, provider, machine))
+                               for provider, ok in zip(sorted(providers), fetched)
+                               if ok])
+
+    # Other runs sharing the cache may be installing from the mirror, they hold
+    # the lock shared while they do.
+    with cache.lock(_lock_path(mirror_dir)):
+        cache.evict(glob.glob(os.path.join(mirror_dir, '*', '*', '*', '*.zip')),
+                    config['max_size_mb'] * 1024 * 1024)
+
+    cli_config_path = os.path.join(state.tmpdir, 'terraformrc')
+    with open(cli_config_path, 'w') as f:
+        f.write(cli_config)
+        f.write(CLI_CONFIG.format(path=mirror_dir))
+
+    env = state.env.copy()
+    env[CLI_CONFIG_FILE_VAR] = cli_config_path
+    env[MIRROR_DIR_VAR] = mirror_dir
+    return state._replace(env=env)
+
+
+@contextlib.contextmanager
+def lock(env):
+    """Hold the mirror lock shared for the duration of an init that may install
+    from it, so it is not evicted from under the init.
+
+    """
+    mirror_dir = env.get(MIRROR_DIR_VAR)
+    if mirror_dir:
+        with cache.lock(_lock_path(mirror_dir), shared=True):
+            yield
+    else:
+        yield
@@ -92,6 +92,19 @@ def get_parallelism(repo_config):
     return repo_config.get('parallel_runs', 3)
 
 
+def get_executor(repo_config):
+    return repo_config.get('executor', 'process')
+
+
+def get_http(repo_config):
+    http = _get(repo_config, 'http', {})
+    return {
+        'pool_connections': _get(http, 'pool_connections', 10),
+        'pool_maxsize': _get(http, 'pool_maxsize', 20),
+        'compress_results': _get(http, 'compress_results', False),
+    }
+
+
 def get_create_and_select_workspace(repo_config, path):
     dirs = repo_config.get('dirs')
     if dirs is None:
@@ -105,7 +118,55 @@ def get_cost_estimation(repo_config):
     return {
         'enabled': cost_estimation.get('enabled', True),
         'provider': cost_estimation.get('provider', 'infracost'),
-        'currency': cost_estimation.get('currency', 'USD')
+        'currency': cost_estimation.get('currency', 'USD'),
+        'source': cost_estimation.get('source', 'hcl'),
+        'cache': _get_cost_estimation_cache(cost_estimation),
+    }
+
+
+def _get_cost_estimation_cache(cost_estimation):
+    cache = _get(cost_estimation, 'cache', {})
+    return {
+        'enabled': _get(cache, 'enabled', True),
+        'path': _get(cache, 'path', None),
+        'max_size_mb': _get(cache, 'max_size_mb', 256),
+        'ttl_hours': _get(cache, 'ttl_hours', 24),
+    }
+
+
+def get_plugin_cache(repo_config):
+    plugin_cache = _get(repo_config, 'plugin_cache', {})
+    return {
+        'enabled': _get(plugin_cache, 'enabled', False),
+        'path': _get(plugin_cache, 'path', None),
+        'max_size_mb': _get(plugin_cache, 'max_size_mb', 10240),
+    }
+
+
+def get_terraform_cache(repo_config):
+    terraform_cache = _get(repo_config, 'terraform_cache', {})
+    return {
+        'path': _get(terraform_cache, 'path', None),
+        'max_size_mb': _get(terraform_cache, 'max_size_mb', 2048),
+    }
+
+
+def get_init_cache(repo_config):
+    init_cache = _get(repo_config, 'init_cache', {})
+    return {
+        'enabled': _get(init_cache, 'enabled', False),
+        'path': _get(init_cache, 'path', None),
+        'max_size_mb': _get(init_cache, 'max_size_mb', 10240),
+    }
+
+
+def get_provider_mirror(repo_config):
+    provider_mirror = _get(repo_config, 'provider_mirror', {})
+    return {
+        'enabled': _get(provider_mirror, 'enabled', False),
+        'path': _get(provider_mirror, 'path', None),
+        'parallelism': _get(provider_mirror, 'parallelism', 8),
+        'max_size_mb': _get(provider_mirror, 'max_size_mb', 10240),
     }
 
 
@@ -1,6 +1,10 @@
+import email.utils
 import logging
+import os
+import time
 
 import requests
+import requests.adapters
 
 import retry
 
@@ -8,6 +12,91 @@ import retry
 TRIES = 5
 INITIAL_SLEEP = 1
 BACKOFF = 1.5
+MAX_SLEEP = 30
+
+# Stop retrying a call once this many seconds have passed since it was first
+# made.
+DEADLINE = 300
+
+# Never wait longer than this for a Retry-After or rate limit reset.
+MAX_RETRY_AFTER = 120
+
+# The retries allowed across the entire run, as a bucket of tokens which is
+# refilled over time.  This is created when the module is loaded, so it is
+# shared by every process forked from the runner.  When an API is down, this
+# keeps every worker from spending all of its tries on every call, and once it
+# is back up the budget is recovered for later calls.
+RETRY_BUDGET = 100
+RETRY_BUDGET_REFILL_PER_SECOND = 1
+_retry_budget = retry.Token_bucket(RETRY_BUDGET, RETRY_BUDGET_REFILL_PER_SECOND)
+
+# 501 and 505 will never succeed on a retry.
+NOT_RETRYABLE_STATUS_CODES = [501, 505]
+
+CHUNK_SIZE = 1024 * 1024
+
+# Number of hosts to keep connection pools for and the number of connections to
+# keep open per host.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+
+# Sessions are per process.  A session inherited from the parent over a fork
+# shares its sockets with the parent, so a process only ever uses the session it
+# created itself.
+_session_pid = None
+_session = None
+
+
+class File_body(object):
+    """A request body which streams the contents of a file rather than loading
+    it into memory.  The file is opened each time the body is iterated, so a
+    retried request sends the whole file again.  If a [hash_factory] is given,
+    such as hashlib.md5, [hexdigest] is the hash of the contents sent by the
+    last complete iteration.
+
+    """
+    def __init__(self, path, hash_factory=None):
+        self.path = path
+        self.hash_factory = hash_factory
+        self.hexdigest = None
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+    def __iter__(self):
+        h = self.hash_factory() if self.hash_factory else None
+        with open(self.path, 'rb') as f:
+            chunk = f.read(CHUNK_SIZE)
+            while chunk:
+                if h:
+                    h.update(chunk)
+                yield chunk
+                chunk = f.read(CHUNK_SIZE)
+
+        if h:
+            self.hexdigest = h.hexdigest()
+
+
+def configure(pool_connections, pool_maxsize):
+    global POOL_CONNECTIONS, POOL_MAXSIZE, _session_pid, _session
+    POOL_CONNECTIONS = pool_connections
+    POOL_MAXSIZE = pool_maxsize
+    _session_pid = None
+    _session = None
+
+
+def _get_session():
+    global _session_pid, _session
+    if _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                                pool_maxsize=POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session = session
+        _session_pid = os.getpid()
+
+    return _session
 
 
 def _wrap_call(f):
@@ -17,20 +106,92 @@ def _wrap_call(f):
         return (False, exn)
 
 
+def _is_rate_limited(res):
+    return (res.status_code == 429
+            or (res.status_code == 403 and res.headers.get('x-ratelimit-remaining') == '0'))
+
+
+def _retry_after(res):
+    """Return the number of seconds the server asked us to wait before retrying,
+    or None.
+
+    """
+    retry_after = res.headers.get('retry-after')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    ratelimit_reset = res.headers.get('x-ratelimit-reset')
+    if res.headers.get('x-ratelimit-remaining') == '0' and ratelimit_reset:
+        try:
+            return max(0.0, float(ratelimit_reset) - time.time())
+        except ValueError:
+            pass
+
+    return None
+
+
 def _test_success(v):
     success, ret = v
-    if not success or (ret.status_code >= 500 and ret.status_code < 600) or ret.status_code == 429:
+    if not success:
+        logging.error('REQUESTS : FAILED : %r', ret)
+        return False
+    elif _is_rate_limited(ret):
+        logging.error('REQUESTS : RATE_LIMITED : %r', ret)
+        return False
+    elif (ret.status_code >= 500
+          and ret.status_code < 600
+          and ret.status_code not in NOT_RETRYABLE_STATUS_CODES):
         logging.error('REQUESTS : FAILED : %r', ret)
         return False
 
     return True
 
 
+def _betwixt_retry_after(last, betwixt):
+    # If the server told us how long to wait, wait that long, otherwise fall back
+    # to [betwixt].
+    def _f():
+        success, ret = last[0]
+        retry_after = _retry_after(ret) if success else None
+        if retry_after is not None:
+            retry_after = min(retry_after, MAX_RETRY_AFTER)
+            logging.info('REQUESTS : RETRY_AFTER : %.1f', retry_after)
+            time.sleep(retry_after)
+        else:
+            betwixt()
+
+    return _f
+
+
 def _wrap(f):
+    # The last result, so the time between tries can take the response into
+    # account.
+    last = [None]
+
+    def _call():
+        if last[0] and last[0][0]:
+            # The response is being retried, so it is not going to be read.  A
+            # streamed response would otherwise hold its connection.
+            last[0][1].close()
+
+        last[0] = _wrap_call(f)
+        return last[0]
+
     (success, res) = retry.run(
-        lambda: _wrap_call(f),
-        retry.finite_tries(TRIES, _test_success),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
+        _call,
+        retry.finite_tries(TRIES,
+                           retry.deadline(DEADLINE,
+                                          retry.budget(_retry_budget, _test_success))),
+        _betwixt_retry_after(last,
+                             retry.betwixt_sleep_with_jitter(INITIAL_SLEEP, BACKOFF, MAX_SLEEP)))
 
     if not success:
         raise res
@@ -39,12 +200,16 @@ def _wrap(f):
 
 
 def post(*args, **kwargs):
-    return _wrap(lambda: requests.post(*args, **kwargs))
+    return _wrap(lambda: _get_session().post(*args, **kwargs))
 
 
 def put(*args, **kwargs):
-    return _wrap(lambda: requests.put(*args, **kwargs))
+    return _wrap(lambda: _get_session().put(*args, **kwargs))
 
 
 def get(*args, **kwargs):
-    return _wrap(lambda: requests.get(*args, **kwargs))
+    return _wrap(lambda: _get_session().get(*args, **kwargs))
+
+
+def request(method, *args, **kwargs):
+    return _wrap(lambda: _get_session().request(method, *args, **kwargs))
@@ -0,0 +1,152 @@
+# Tracking of the resources available to the runner, used to decide how many
+# dirspaces can be executed at the same time when the parallelism is 'auto'.
+import collections
+import logging
+import os
+import resource
+import time
+
+
+AUTO = 'auto'
+
+# Estimate of the memory a dirspace needs until a terraform process has been
+# observed.
+DEFAULT_DIRSPACE_MEMORY = 512 * 1024 * 1024
+
+# Do not start new dirspaces if doing so would leave less than this much memory
+# available.
+MIN_FREE_MEMORY = 256 * 1024 * 1024
+
+# How long after a dirspace is started its memory use is assumed to not yet be
+# reflected in the memory available.
+RAMP_UP_SECONDS = 30
+
+CGROUP_V2_MEMORY = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current')
+CGROUP_V1_MEMORY = ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _read_meminfo_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    # Reported in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def _read_cgroup_available():
+    # Inside of a container the host memory is not what we are limited by, if
+    # there is a cgroup limit then use whatever is left of it.
+    for limit_path, usage_path in [CGROUP_V2_MEMORY, CGROUP_V1_MEMORY]:
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read().strip())
+
+            if limit == 'max':
+                return None
+
+            return max(0, int(limit) - usage)
+        except (OSError, ValueError):
+            pass
+
+    return None
+
+
+def mem_available():
+    """Return the number of bytes of memory available, or None if it cannot be
+    determined.
+
+    """
+    available = [v
+                 for v in [_read_meminfo_available(), _read_cgroup_available()]
+                 if v is not None]
+    if available:
+        return min(available)
+    else:
+        return None
+
+
+def children_peak_rss():
+    """Return the peak RSS, in bytes, of any child process of this process that
+    has been waited on.
+
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+class Limiter(object):
+    """Decides if another dirspace can be started given how many are currently
+    running.  With a fixed parallelism this is just a count, with 'auto' the
+    CPU count, available memory, and the peak RSS of the terraform processes
+    seen so far are taken into account.
+
+    """
+    def __init__(self, parallel):
+        self.parallel = parallel
+        self.peak_rss = 0
+        self.starts = collections.deque()
+
+    def max_parallel(self):
+        if self.parallel == AUTO:
+            return cpu_count()
+        else:
+            return self.parallel
+
+    def update_peak_rss(self, peak_rss):
+        self.peak_rss = max(self.peak_rss, peak_rss)
+
+    def started(self):
+        """Record that a dirspace has been started."""
+        self.starts.append(time.monotonic())
+
+    def _ramping_up(self, running):
+        now = time.monotonic()
+        while self.starts and now - self.starts[0] > RAMP_UP_SECONDS:
+            self.starts.popleft()
+
+        # Any that have already finished are not using memory.
+        return min(len(self.starts), running)
+
+    def can_start(self, running):
+        # Always allow one dirspace to run, otherwise we could never make
+        # progress.
+        if running == 0:
+            return True
+        elif running >= self.max_parallel():
+            return False
+        elif self.parallel != AUTO:
+            return True
+
+        available = mem_available()
+        if available is None:
+            return True
+
+        # Dirspaces which were only just started have not allocated their
+        # memory yet, so reserve it for them as well as the new one.
+        needed = max(self.peak_rss, DEFAULT_DIRSPACE_MEMORY)
+        ramping_up = self._ramping_up(running)
+        if available - needed * (ramping_up + 1) < MIN_FREE_MEMORY:
+            logging.debug(
+                'RESOURCES : WAITING : running=%d : ramping_up=%d : available=%d : needed=%d',
+                running,
+                ramping_up,
+                available,
+                needed)
+            return False
+
+        return True
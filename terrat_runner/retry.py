@@ -1,3 +1,5 @@
+import multiprocessing
+import random
 import time
 
 
@@ -15,6 +17,21 @@ def betwixt_sleep_with_backoff(initial_sleep, backoff):
     return _f
 
 
+def betwixt_sleep_with_jitter(initial_sleep, backoff, max_sleep):
+    """Like [betwixt_sleep_with_backoff] but sleep for a random time between 0
+    and the current sleep time, which is capped at [max_sleep].  This keeps many
+    callers failing at the same time from retrying in lockstep.
+
+    """
+    sleep_time = [initial_sleep]
+
+    def _f():
+        time.sleep(random.uniform(0, sleep_time[0]))
+        sleep_time[0] = min(sleep_time[0] * backoff, max_sleep)
+
+    return _f
+
+
 def finite_tries(tries, f):
     """Try for a number of tries and once reached, return whatever the value is.
     [f] should return [False] if another try should be attempted.
@@ -32,6 +49,66 @@ def finite_tries(tries, f):
     return _f
 
 
+def deadline(seconds, f):
+    """Try until [seconds] have passed since the deadline was created and once
+    reached, return whatever the value is.  [f] should return [False] if another
+    try should be attempted.
+
+    """
+    end = time.monotonic() + seconds
+
+    def _f(ret):
+        if time.monotonic() < end:
+            return f(ret)
+        else:
+            return True
+
+    return _f
+
+
+class Token_bucket(object):
+    """Holds up to [capacity] tokens and is refilled at [refill_per_second]
+    tokens a second.  It is shared by every caller, even across processes forked
+    after it is created.
+
+    """
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        # The tokens and the time they were last refilled at.
+        self._state = multiprocessing.Array('d', [capacity, time.monotonic()])
+
+    def take(self):
+        """Take a token, returning [False] if there are none."""
+        with self._state.get_lock():
+            now = time.monotonic()
+            tokens = min(self.capacity,
+                         self._state[0] + (now - self._state[1]) * self.refill_per_second)
+            self._state[1] = now
+
+            if tokens < 1:
+                self._state[0] = tokens
+                return False
+
+            self._state[0] = tokens - 1
+            return True
+
+
+def budget(bucket, f):
+    """Each retry takes a token from [bucket], a [Token_bucket].  Once it is
+    empty, return whatever the value is.  [f] should return [False] if another
+    try should be attempted.
+
+    """
+    def _f(ret):
+        if f(ret):
+            return True
+
+        return not bucket.take()
+
+    return _f
+
+
 def run(f, test, betwixt):
     """Run a function and collect its return, then test the result.  If the test
     returns [True] then return the value, otherwise run the [betwixt] function
@@ -41,8 +118,8 @@ def run(f, test, betwixt):
 
     """
     ret = f()
-    if test(ret):
-        return ret
-    else:
+    while not test(ret):
         betwixt()
-        return run(f, test, betwixt)
+        ret = f()
+
+    return ret
@@ -0,0 +1,145 @@
+# Installation of the Terraform versions a run needs.  Every version is
+# installed before any dirspace is executed, concurrently, and the steps run the
+# installed binary directly.  Release archives are verified against their
+# SHA256SUMS and kept in the cache, so with a persistent TERRATEAM_CACHE_DIR a
+# version is only ever downloaded once.
+#
+# Binaries are installed to the same place, and under the same per-version lock,
+# as /install-terraform-version, so the two can be used side by side.
+import concurrent.futures
+import glob
+import logging
+import os
+import shutil
+import zipfile
+
+import cache
+import repo_config as rc
+import requests_retry
+
+
+VERSIONS_DIR = '/usr/local/tf/versions'
+
+RELEASES_URL = 'https://releases.hashicorp.com/terraform'
+
+INSTALL_PARALLELISM = 4
+
+
+def _resolve(env, version):
+    if version == 'latest':
+        return env['DEFAULT_TERRAFORM_VERSION']
+    else:
+        return version
+
+
+def _binary_path(version):
+    return os.path.join(VERSIONS_DIR, version, 'terraform')
+
+
+def _lock_path(version):
+    return os.path.join(VERSIONS_DIR, '.{}.lock'.format(version))
+
+
+def _archives_dir(state):
+    config = rc.get_terraform_cache(state.repo_config)
+    return os.path.expanduser(config['path'] or os.path.join(cache.root(state.env), 'terraform'))
+
+
+def _archive_name(version):
+    os_, arch = cache.target()
+    return 'terraform_{}_{}_{}.zip'.format(version, os_, arch)
+
+
+def _shasum(version, archive_name):
+    url = '{}/{}/terraform_{}_SHA256SUMS'.format(RELEASES_URL, version, version)
+    res = requests_retry.get(url)
+    if res.status_code != 200:
+        raise Exception('Download failed: {}: {}'.format(url, res.status_code))
+
+    for line in res.text.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == archive_name:
+            return parts[0]
+
+    raise Exception('No checksum for {} in {}'.format(archive_name, url))
+
+
+def _fetch_archive(archives_dir, version):
+    archive_name = _archive_name(version)
+    dest = os.path.join(archives_dir, archive_name)
+
+    if os.path.exists(dest):
+        # Archives are only moved into place once they have been verified.
+        logging.debug('TERRAFORM_INSTALL : HIT : %s', dest)
+        cache.touch(dest)
+        return dest
+
+    logging.info('TERRAFORM_INSTALL : DOWNLOAD : %s', archive_name)
+    cache.download(dest,
+                   '{}/{}/{}'.format(RELEASES_URL, version, archive_name),
+                   _shasum(version, archive_name))
+    return dest
+
+
+def install(state, version):
+    """Install Terraform [version], if it is not already, and return the path to
+    its binary.
+
+    """
+    version = _resolve(state.env, version)
+    path = _binary_path(version)
+
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(VERSIONS_DIR, exist_ok=True)
+    with cache.lock(_lock_path(version)):
+        if os.path.exists(path):
+            return path
+
+        archives_dir = _archives_dir(state)
+        # Shared so that eviction cannot remove the archive before it has been
+        # unpacked.
+        with cache.lock(os.path.join(archives_dir, '.lock'), shared=True):
+            archive = _fetch_archive(archives_dir, version)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+            with zipfile.ZipFile(archive) as z:
+                with z.open('terraform') as src, open(tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+
+        os.chmod(tmp_path, 0o755)
+        os.rename(tmp_path, path)
+
+    logging.info('TERRAFORM_INSTALL : INSTALLED : %s', path)
+    return path
+
+
+def start(state, versions):
+    """Start installing [versions] in the background.  Returns the running
+    installs, to be passed to [wait].
+
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(INSTALL_PARALLELISM)
+    futures = [(version, executor.submit(install, state, version))
+               for version in sorted(versions)]
+    return (executor, futures)
+
+
+def wait(state, installs):
+    executor, futures = installs
+    for version, future in futures:
+        exn = future.exception()
+        if exn:
+            # Not fatal here, the step that needs the version will try again
+            # and report the error in its output.
+            logging.warning('TERRAFORM_INSTALL : FAILED : %s : %s', version, exn)
+
+    executor.shutdown()
+
+    config = rc.get_terraform_cache(state.repo_config)
+    archives_dir = _archives_dir(state)
+    with cache.lock(os.path.join(archives_dir, '.lock')):
+        cache.evict(glob.glob(os.path.join(archives_dir, '*.zip')),
+                    config['max_size_mb'] * 1024 * 1024)
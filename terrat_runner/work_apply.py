@@ -1,35 +1,239 @@
 import base64
+import fcntl
 import hashlib
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import re
+import shutil
 import tempfile
+import time
 
+import content_encoding
 import repo_config as rc
 import requests_retry
+import retry
 import work_exec
 import workflow_step
 import workflow_step_terrateam_ssh_key_setup
 
 
-def _load_plan(work_token, api_base_url, dir_path, workspace, plan_path):
-    res = requests_retry.get(api_base_url + '/v1/work-manifests/' + work_token + '/plans',
-                             params={'path': dir_path, 'workspace': workspace})
+# Number of plans to download at once when prefetching
+PLAN_PREFETCH_PARALLELISM = 4
+
+# How long a dirspace will wait for its plan to be prefetched before
+# downloading it itself.
+PLAN_PREFETCH_TIMEOUT = 600
+PLAN_PREFETCH_POLL_INTERVAL = 0.5
+
+# Tries for downloading a plan if the connection fails while its body is being
+# read.
+LOAD_PLAN_TRIES = 3
+LOAD_PLAN_INITIAL_SLEEP = 1
+LOAD_PLAN_BACKOFF = 1.5
+LOAD_PLAN_MAX_SLEEP = 10
+
+JSON_PLAN_DATA_START = re.compile(rb'"data"\s*:\s*"')
+
+
+def _json_plan_data(chunks):
+    # Versions of the API which do not support returning the raw plan respond
+    # with {"data": "<base64>"}.  Rather than loading the whole response and
+    # decoding it, find the start of the data string and decode it as it streams
+    # in, a multiple of 4 base64 characters at a time.
+    chunks = iter(chunks)
 
-    if res.status_code != 200:
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        m = JSON_PLAN_DATA_START.search(buf)
+        if m:
+            buf = buf[m.end():]
+            break
+    else:
         raise Exception('Could not load plan')
 
-    plan_raw_data = base64.b64decode(res.json()['data'])
+    pending = b''
+    while True:
+        end = buf.find(b'"')
+        # Base64 does not need escaping in JSON, except that a '/' may have
+        # been escaped as '\/'.
+        pending += (buf if end == -1 else buf[:end]).replace(b'\\', b'')
+        n = len(pending) - len(pending) % 4
+        if n:
+            yield base64.b64decode(pending[:n])
+            pending = pending[n:]
+
+        if end != -1:
+            break
+
+        buf = next(chunks, None)
+        if buf is None:
+            raise Exception('Could not load plan')
+
+    if pending:
+        yield base64.b64decode(pending)
+
+
+def _write_plan(res, plan_path):
+    # The plan is written to disk as it is received so that memory usage does
+    # not depend on the size of the plan.
+    chunks = content_encoding.response_chunks(res, requests_retry.CHUNK_SIZE)
+    if not res.headers.get('content-type', '').startswith('application/octet-stream'):
+        chunks = _json_plan_data(chunks)
+
+    md5 = hashlib.md5()
+    with open(plan_path, 'wb') as f:
+        for chunk in chunks:
+            md5.update(chunk)
+            f.write(chunk)
+
+    return md5.hexdigest()
+
+
+def _load_plan(work_token, api_base_url, dir_path, workspace, plan_path):
+    def _f():
+        res = requests_retry.get(api_base_url + '/v1/work-manifests/' + work_token + '/plans',
+                                 params={'path': dir_path, 'workspace': workspace},
+                                 headers={
+                                     'accept': 'application/octet-stream, application/json',
+                                     'accept-encoding': content_encoding.accept_encoding(),
+                                 },
+                                 stream=True)
+
+        with res:
+            if res.status_code != 200:
+                # Failures which are worth retrying have already been retried.
+                raise Exception('Could not load plan')
+
+            # The body is read after the request has succeeded, so the whole
+            # download is tried again if it fails part way through.
+            try:
+                return (True, _write_plan(res, plan_path))
+            except Exception as exn:
+                return (False, exn)
+
+    def _test(ret):
+        success, v = ret
+        if not success:
+            logging.error('APPLY : LOAD_PLAN : RETRY : %s : %s : %s', dir_path, workspace, v)
+
+        return success
+
+    (success, v) = retry.run(
+        _f,
+        retry.finite_tries(LOAD_PLAN_TRIES, _test),
+        retry.betwixt_sleep_with_jitter(LOAD_PLAN_INITIAL_SLEEP,
+                                        LOAD_PLAN_BACKOFF,
+                                        LOAD_PLAN_MAX_SLEEP))
+
+    if not success:
+        raise v
 
     logging.debug('APPLY : LOAD_PLAN : dir_path=%s : workspace=%s : md5=%s',
                   dir_path,
                   workspace,
-                  hashlib.md5(plan_raw_data).hexdigest())
+                  v)
 
-    with open(plan_path, 'wb') as f:
-        f.write(plan_raw_data)
+
+def _prefetched_plan_path(plans_dir, d):
+    filename_str = ','.join([d['path'], d['workspace']]).encode('utf-8')
+    return os.path.join(plans_dir, hashlib.sha256(filename_str).hexdigest())
+
+
+def _prefetch_plan(work_token, api_base_url, plans_dir, d):
+    plan_path = _prefetched_plan_path(plans_dir, d)
+    try:
+        # Download to a temporary name and rename it once it is complete so a
+        # dirspace never sees a partial plan.
+        _load_plan(work_token, api_base_url, d['path'], d['workspace'], plan_path + '.tmp')
+        os.rename(plan_path + '.tmp', plan_path)
+    except Exception as exn:
+        logging.error('APPLY : PREFETCH_PLAN : FAIL : %s : %s : %s', d['path'], d['workspace'], exn)
+        with open(plan_path + '.failed', 'w'):
+            pass
+
+
+def _prefetch_plans(work_token, api_base_url, plans_dir, dirspaces):
+    # The lock is held for as long as this process is alive, it is released by
+    # the kernel however the process exits, so a dirspace waiting on a plan can
+    # tell if the process died without finishing.
+    with open(os.path.join(plans_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(os.path.join(plans_dir, '.started'), 'w'):
+            pass
+
+        try:
+            with multiprocessing.pool.ThreadPool(PLAN_PREFETCH_PARALLELISM) as p:
+                p.map(lambda d: _prefetch_plan(work_token, api_base_url, plans_dir, d), dirspaces)
+        finally:
+            with open(os.path.join(plans_dir, '.done'), 'w'):
+                pass
+
+
+def _prefetch_running(plans_dir):
+    if not os.path.exists(os.path.join(plans_dir, '.started')):
+        # Not yet started, or not prefetching at all, which the timeout covers.
+        return True
+
+    with open(os.path.join(plans_dir, '.lock')) as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+
+
+def _wait_for_prefetched_plan(plans_dir, d):
+    """Wait for the plan of the dirspace to be prefetched and return its path,
+    or None if it was not prefetched.
+
+    """
+    plan_path = _prefetched_plan_path(plans_dir, d)
+    done_path = os.path.join(plans_dir, '.done')
+    start = time.monotonic()
+    while time.monotonic() - start < PLAN_PREFETCH_TIMEOUT:
+        if os.path.exists(plan_path):
+            return plan_path
+        elif os.path.exists(plan_path + '.failed'):
+            return None
+        elif os.path.exists(done_path):
+            break
+        elif not _prefetch_running(plans_dir):
+            # It may also have finished since the check above.
+            if not os.path.exists(done_path):
+                logging.error('APPLY : PREFETCH_PLAN : DIED : %s : %s', d['path'], d['workspace'])
+            break
+
+        time.sleep(PLAN_PREFETCH_POLL_INTERVAL)
+
+    if os.path.exists(plan_path):
+        return plan_path
+    else:
+        return None
 
 
 class Exec(work_exec.ExecInterface):
+    def prefetch(self, state):
+        # Download every plan in the background as soon as the work manifest is
+        # known, so the downloads overlap with the pre hooks and earlier ranks.
+        # This is done in its own process so the threads it uses never exist in
+        # the process that the dirspace workers are forked from.
+        plans_dir = os.path.join(state.tmpdir, 'plans')
+        os.makedirs(plans_dir, exist_ok=True)
+        dirspaces = sorted(state.work_manifest['changed_dirspaces'], key=lambda d: d['rank'])
+        p = multiprocessing.Process(target=_prefetch_plans,
+                                    args=(state.work_token,
+                                          state.api_base_url,
+                                          plans_dir,
+                                          dirspaces),
+                                    daemon=True)
+        p.start()
+        return p
+
     def pre_hooks(self, state):
         pre_hooks = rc.get_all_hooks(state.repo_config)['pre']
 
@@ -59,14 +263,20 @@ class Exec(work_exec.ExecInterface):
             workspace = d['workspace']
             workflow_idx = d.get('workflow')
 
-            _load_plan(state.work_token,
-                       state.api_base_url,
-                       path,
-                       workspace,
-                       os.path.join(tmpdir, 'plan'))
+            prefetched_plan = _wait_for_prefetched_plan(os.path.join(state.tmpdir, 'plans'), d)
+
+            if prefetched_plan:
+                shutil.move(prefetched_plan, os.path.join(tmpdir, 'plan'))
+            else:
+                _load_plan(state.work_token,
+                           state.api_base_url,
+                           path,
+                           workspace,
+                           os.path.join(tmpdir, 'plan'))
 
             env = state.env.copy()
             env['TERRATEAM_PLAN_FILE'] = os.path.join(tmpdir, 'plan')
+            env['TERRATEAM_PLAN_JSON_FILE'] = os.path.join(tmpdir, 'plan.json')
             env['TERRATEAM_DIR'] = path
             env['TERRATEAM_WORKSPACE'] = workspace
             env['TERRATEAM_TMPDIR'] = tmpdir
@@ -1,16 +1,49 @@
 import abc
+import hashlib
 import json
 import logging
 import os
+import shutil
 import tempfile
 
+import content_encoding
 import dir_exec
 import hooks
+import plugin_cache
+import provider_mirror
 import repo_config as rc
 import requests_retry
+import terraform_install
+
+
+# The API responds with one of these if it does not support the content encoding
+# of the results: a 415 if it checks the encoding, a 400 if it tries to parse the
+# encoded body as JSON.
+ENCODING_UNSUPPORTED_STATUS_CODES = [400, 415]
+
+# Versions of the API without an endpoint for the result of a single dirspace
+# respond with one of these.
+DIRSPACE_RESULTS_UNSUPPORTED_STATUS_CODES = [404, 405]
+
+# Written to the dirspaces dir of the run once the API is known to not support
+# the results of a single dirspace, so no other dirspace tries.
+DIRSPACE_RESULTS_UNSUPPORTED_FILE = '.unsupported'
+
+DIR_EXEC_DISPATCH = {
+    'process': dir_exec.run,
+    'thread': dir_exec.run_thread,
+}
 
 
 class ExecInterface(abc.ABC):
+    @abc.abstractmethod
+    def prefetch(self, state):
+        """Start any work that can be done in the background as soon as the work
+        manifest is known.  Returns a multiprocessing.Process, or None.
+
+        """
+        pass
+
     @abc.abstractmethod
     def pre_hooks(self, state):
         pass
@@ -40,13 +73,144 @@ def determine_tf_version(repo_root, working_dir, workflow_version):
         return workflow_version
 
 
-def _store_results(work_token, api_base_url, results):
-    res = requests_retry.put(api_base_url + '/v1/work-manifests/' + work_token,
-                             json=results)
+def _terraform_versions(state):
+    # The version used by hooks, as well as that of every dirspace.
+    versions = {state.env['TERRATEAM_TERRAFORM_VERSION']}
+
+    for d in state.work_manifest['changed_dirspaces']:
+        workflow_idx = d.get('workflow')
+
+        if workflow_idx is None:
+            workflow = rc.get_default_workflow(state.repo_config)
+        else:
+            workflow = rc.get_workflow(state.repo_config, workflow_idx)
+
+        versions.add(determine_tf_version(
+            state.working_dir,
+            os.path.join(state.working_dir, d['path']),
+            workflow['terraform_version']))
+
+    return versions
+
+
+def _encode_file(path, encoding):
+    # The results are encoded once, up front, so that a retried request only
+    # has to stream the encoded file again.
+    if encoding == content_encoding.IDENTITY:
+        return path
+
+    encoded_path = '{}.{}'.format(path, encoding)
+    with open(encoded_path, 'wb') as f:
+        for chunk in content_encoding.compress(encoding, requests_retry.File_body(path)):
+            f.write(chunk)
+
+    return encoded_path
+
+
+def _store_results(work_token, api_base_url, results_path, compress):
+    # Compression is opt-in, as not every version of the API decodes it.  If it
+    # is enabled, try each encoding we support, in order of preference, falling
+    # back to an uncompressed body if the API does not support any of them.
+    if compress:
+        encodings = content_encoding.supported() + [content_encoding.IDENTITY]
+    else:
+        encodings = [content_encoding.IDENTITY]
+
+    for encoding in encodings:
+        headers = {'content-type': 'application/json'}
+        if encoding != content_encoding.IDENTITY:
+            headers['content-encoding'] = encoding
+
+        body = requests_retry.File_body(_encode_file(results_path, encoding))
+        res = requests_retry.put(api_base_url + '/v1/work-manifests/' + work_token,
+                                 headers=headers,
+                                 data=body)
+
+        logging.debug('EXEC : STORE_RESULTS : encoding=%s : size=%d : status_code=%d',
+                      encoding,
+                      len(body),
+                      res.status_code)
+
+        if res.status_code not in ENCODING_UNSUPPORTED_STATUS_CODES:
+            break
 
     return res.status_code == 200
 
 
+def _write_json(fname, obj):
+    with open(fname, 'w') as f:
+        json.dump(obj, f)
+
+    return fname
+
+
+def _store_dirspace_result(tmpdir, work_token, api_base_url, result):
+    unsupported_path = os.path.join(tmpdir, 'dirspaces', DIRSPACE_RESULTS_UNSUPPORTED_FILE)
+    if os.path.exists(unsupported_path):
+        return False
+
+    try:
+        res = requests_retry.post(api_base_url + '/v1/work-manifests/' + work_token + '/dirspaces',
+                                  json=result)
+
+        if res.status_code in DIRSPACE_RESULTS_UNSUPPORTED_STATUS_CODES:
+            logging.info('EXEC : STORE_DIRSPACE_RESULT : UNSUPPORTED : status_code=%d',
+                         res.status_code)
+            with open(unsupported_path, 'w'):
+                pass
+
+        return res.status_code == 200
+    except Exception as exn:
+        logging.error('EXEC : STORE_DIRSPACE_RESULT : %s : %s : %s',
+                      result['path'],
+                      result['workspace'],
+                      exn)
+        return False
+
+
+def _dirspace_result_path(tmpdir, dirspace):
+    filename_str = ','.join([dirspace['path'], dirspace['workspace']]).encode('utf-8')
+    return os.path.join(tmpdir, 'dirspaces', hashlib.sha256(filename_str).hexdigest() + '.json')
+
+
+def _exec_dirspace(exec_cb, state, d):
+    # Executed in the worker.  The full result of the dirspace, with all of its
+    # outputs, is written to disk and sent to the API as soon as the dirspace
+    # finishes, only a summary of it is handed back.  This keeps memory flat no
+    # matter how many dirspaces there are and means a failure near the end of
+    # a run does not lose the results that have already been computed.
+    (s, r) = exec_cb.exec(state, d)
+
+    with open(_dirspace_result_path(state.tmpdir, r), 'w') as f:
+        json.dump(r, f)
+
+    stored = _store_dirspace_result(state.tmpdir, state.work_token, state.api_base_url, r)
+
+    return {
+        'path': r['path'],
+        'workspace': r['workspace'],
+        'success': r['success'],
+        'stored': stored,
+    }
+
+
+def _write_results(fname, tmpdir, dirspaces, overall):
+    # Stream the dirspace results from disk into the results file rather than
+    # loading them all.
+    with open(fname, 'w') as f:
+        f.write('{"dirspaces": [')
+        for idx, ds in enumerate(dirspaces):
+            if idx > 0:
+                f.write(', ')
+
+            with open(_dirspace_result_path(tmpdir, ds)) as ds_f:
+                shutil.copyfileobj(ds_f, f)
+
+        f.write('], "overall": ')
+        json.dump(overall, f)
+        f.write('}')
+
+
 def _run(state, exec_cb):
     # Setup the global terraform version, for use if terraform is called in any hooks.
     env = state.env.copy()
@@ -61,11 +225,18 @@ def _run(state, exec_cb):
     env['TERRATEAM_TMPDIR'] = state.tmpdir
     state = state._replace(env=env)
 
+    state = plugin_cache.setup(state)
+
+    # Install the Terraform versions while the pre hooks run.
+    terraform_installs = terraform_install.start(state, _terraform_versions(state))
+
     pre_hooks = exec_cb.pre_hooks(state)
 
     logging.debug('EXEC : HOOKS : PRE')
     state = hooks.run_pre_hooks(state, pre_hooks)
 
+    terraform_install.wait(state, terraform_installs)
+
     # Bail out if we failed in prehooks
     if state.failed:
         results = {
@@ -86,7 +257,11 @@ def _run(state, exec_cb):
                 }
             },
         }
-        ret = _store_results(state.work_token, state.api_base_url, results)
+        ret = _store_results(state.work_token,
+                             state.api_base_url,
+                             _write_json(os.path.join(state.tmpdir, 'results-pre-hooks.json'),
+                                         results),
+                             rc.get_http(state.repo_config)['compress_results'])
 
         if not ret:
             raise Exception('Failed to send results')
@@ -97,29 +272,43 @@ def _run(state, exec_cb):
 
     state = state._replace(outputs=[])
 
-    res = dir_exec.run(rc.get_parallelism(state.repo_config),
-                       state.work_manifest['changed_dirspaces'],
-                       exec_cb.exec,
-                       (state,))
+    # Done after the pre hooks, as they may write the Terraform CLI
+    # configuration.
+    state = provider_mirror.setup(state)
+
+    executor = rc.get_executor(state.repo_config)
+
+    if executor not in DIR_EXEC_DISPATCH:
+        raise Exception('Unknown executor: {}'.format(executor))
+
+    logging.debug('EXEC : EXECUTOR : %s', executor)
+
+    os.makedirs(os.path.join(state.tmpdir, 'dirspaces'), exist_ok=True)
+
+    res = DIR_EXEC_DISPATCH[executor](rc.get_parallelism(state.repo_config),
+                                      state.work_manifest['changed_dirspaces'],
+                                      _exec_dirspace,
+                                      (exec_cb, state))
 
     dirspaces = []
-    for (s, r) in res:
-        state = state._replace(failed=state.failed or s.failed)
-        dirspaces.append(r)
+    all_stored = True
+    for r in res:
+        state = state._replace(failed=state.failed or not r['success'])
+        all_stored = all_stored and r['stored']
+        dirspaces.append({
+            'path': r['path'],
+            'workspace': r['workspace'],
+            'success': r['success'],
+        })
 
     logging.debug('EXEC : HOOKS : POST')
 
     results_json = os.path.join(state.tmpdir, 'results.json')
 
-    results = {
-        'dirspaces': dirspaces,
-        'overall': {
-            'success': not state.failed,
-        }
-    }
-
-    with open(results_json, 'w') as f:
-        f.write(json.dumps(results))
+    _write_results(results_json,
+                   state.tmpdir,
+                   dirspaces,
+                   {'success': not state.failed})
 
     env = state.env.copy()
     env['TERRATEAM_RESULTS_FILE'] = results_json
@@ -128,18 +317,39 @@ def _run(state, exec_cb):
     post_hooks = exec_cb.post_hooks(state)
     state = hooks.run_post_hooks(state._replace(outputs=[]), post_hooks)
 
-    results['overall']['success'] = not state.failed
-    results['overall']['outputs'] = {
-        'pre': pre_hook_outputs,
-        'post': state.outputs
+    overall = {
+        'success': not state.failed,
+        'outputs': {
+            'pre': pre_hook_outputs,
+            'post': state.outputs
+        }
     }
 
-    ret = _store_results(state.work_token, state.api_base_url, results)
+    if all_stored:
+        # Every dirspace result has already been sent, so only a summary needs
+        # to be sent to complete the work manifest.
+        logging.debug('EXEC : STORE_RESULTS : SUMMARY')
+        results_path = _write_json(os.path.join(state.tmpdir, 'results-summary.json'),
+                                   {
+                                       'dirspaces': dirspaces,
+                                       'overall': overall,
+                                   })
+    else:
+        # The API does not support storing results per dirspace, or some of
+        # them failed to be sent, so fall back to sending everything.
+        logging.debug('EXEC : STORE_RESULTS : FULL')
+        results_path = os.path.join(state.tmpdir, 'results-full.json')
+        _write_results(results_path, state.tmpdir, dirspaces, overall)
+
+    ret = _store_results(state.work_token,
+                         state.api_base_url,
+                         results_path,
+                         rc.get_http(state.repo_config)['compress_results'])
 
     if not ret:
         raise Exception('Failed to send results')
 
-    if not results['overall']['success']:
+    if not overall['success']:
         raise Exception('Failed executing operation')
 
     return state
@@ -147,4 +357,11 @@ def _run(state, exec_cb):
 
 def run(state, exec_cb):
     with tempfile.TemporaryDirectory() as tmpdir:
-        return _run(state._replace(tmpdir=tmpdir), exec_cb)
+        state = state._replace(tmpdir=tmpdir)
+        prefetch = exec_cb.prefetch(state)
+        try:
+            return _run(state, exec_cb)
+        finally:
+            if prefetch:
+                prefetch.terminate()
+                prefetch.join()
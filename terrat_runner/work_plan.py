@@ -9,6 +9,9 @@ import workflow_step_terrateam_ssh_key_setup
 
 
 class Exec(work_exec.ExecInterface):
+    def prefetch(self, state):
+        return None
+
     def pre_hooks(self, state):
         pre_hooks = rc.get_all_hooks(state.repo_config)['pre']
 
@@ -21,7 +24,7 @@ class Exec(work_exec.ExecInterface):
         pre_hooks.extend(rc.get_plan_hooks(state.repo_config)['pre'])
 
         cost_estimation_config = rc.get_cost_estimation(state.repo_config)
-        if cost_estimation_config['enabled']:
+        if cost_estimation_config['enabled'] and cost_estimation_config['source'] == 'hcl':
             if cost_estimation_config['provider'] == 'infracost':
                 pre_hooks.append(
                     {
@@ -33,7 +36,22 @@ class Exec(work_exec.ExecInterface):
         return pre_hooks
 
     def post_hooks(self, state):
-        return (rc.get_all_hooks(state.repo_config)['post']
+        post_hooks = []
+
+        # Estimating from the plans has to wait for them, so it is run before
+        # any of the user's post hooks.
+        cost_estimation_config = rc.get_cost_estimation(state.repo_config)
+        if cost_estimation_config['enabled'] and cost_estimation_config['source'] == 'plan_json':
+            if cost_estimation_config['provider'] == 'infracost':
+                post_hooks.append(
+                    {
+                        'type': 'infracost_plan_json',
+                        'currency': cost_estimation_config['currency']
+                    }
+                )
+
+        return (post_hooks
+                + rc.get_all_hooks(state.repo_config)['post']
                 + rc.get_plan_hooks(state.repo_config)['post'])
 
     def exec(self, state, d):
@@ -52,6 +70,8 @@ class Exec(work_exec.ExecInterface):
 
             env = state.env.copy()
             env['TERRATEAM_PLAN_FILE'] = plan_file
+            env['TERRATEAM_PLAN_JSON_FILE'] = plan_file + '.json'
+            env['TERRATEAM_PLAN_TEXT_FILE'] = plan_file + '.txt'
             env['TERRATEAM_DIR'] = path
             env['TERRATEAM_WORKSPACE'] = workspace
             env['TERRATEAM_TMPDIR'] = tmpdir
@@ -21,6 +21,9 @@ def _fix_up_apply(steps):
 
 
 class Exec(work_exec.ExecInterface):
+    def prefetch(self, state):
+        return None
+
     def pre_hooks(self, state):
         pre_hooks = rc.get_all_hooks(state.repo_config)['pre']
 
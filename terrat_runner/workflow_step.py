@@ -6,6 +6,7 @@ import github_actions.workflow_step_drift_create_issue
 import workflow
 import workflow_step_apply
 import workflow_step_env
+import workflow_step_infracost_plan_json
 import workflow_step_infracost_setup
 import workflow_step_init
 import workflow_step_oidc
@@ -20,6 +21,7 @@ STEPS = {
     'apply': workflow_step_apply.run,
     'drift_create_issue': github_actions.workflow_step_drift_create_issue.run,
     'env': workflow_step_env.run,
+    'infracost_plan_json': workflow_step_infracost_plan_json.run,
     'infracost_setup': workflow_step_infracost_setup.run,
     'init': workflow_step_init.run,
     'oidc': workflow_step_oidc.run,
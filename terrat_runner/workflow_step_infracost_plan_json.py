@@ -0,0 +1,61 @@
+# Cost estimation from the plans of the dirspaces, run as a post hook.  Only
+# dirspaces whose plan has changes have their plan JSON written, by the plan
+# step, so only those are estimated.  The plan JSON contains the prior state, so
+# infracost can diff it on its own without a breakdown of the base branch.
+import logging
+import os
+
+import infracost
+import workflow_step_infracost_setup
+
+
+def plan_json_dir(state):
+    return os.path.join(state.tmpdir, 'plan-json')
+
+
+def plan_json_path(state, dirspace):
+    return os.path.join(plan_json_dir(state), infracost.json_filename_of_dirspace(dirspace))
+
+
+def run(state, config):
+    return workflow_step_infracost_setup.run_cost_estimation(
+        state,
+        lambda proxied_state: _run(proxied_state, config))
+
+
+def _run(state, config):
+    infracost_dir = os.path.join(state.tmpdir, 'infracost')
+    os.makedirs(infracost_dir, exist_ok=True)
+
+    diff_infracost = os.path.join(infracost_dir, 'infracost-diff.json')
+    infracost_config_yml = os.path.join(infracost_dir, 'config.yml')
+
+    plan_jsons = [(ds, plan_json_path(state, ds))
+                  for ds in state.work_manifest['changed_dirspaces']
+                  if os.path.exists(plan_json_path(state, ds))]
+
+    logging.info('INFRACOST : PLAN_JSON : dirspaces=%d', len(plan_jsons))
+
+    if not plan_jsons:
+        return workflow_step_infracost_setup.empty_result(state, config)
+
+    logging.info('INFRACOST : SETUP')
+    workflow_step_infracost_setup.configure_infracost(state, config)
+
+    infracost.create_plan_json_infracost_yml(infracost_config_yml, plan_jsons)
+
+    output = workflow_step_infracost_setup.run_retry(
+        state,
+        ['infracost',
+         'diff',
+         '--config-file={}'.format(infracost_config_yml),
+         '--format=json',
+         '--out-file={}'.format(diff_infracost)])
+
+    dirspaces_by_name = {'{}:{}'.format(ds['path'], ds['workspace']): (ds['path'], ds['workspace'])
+                         for ds, _ in plan_jsons}
+
+    return workflow_step_infracost_setup.diff_result(state,
+                                                     output,
+                                                     diff_infracost,
+                                                     lambda p: dirspaces_by_name.get(p['name']))
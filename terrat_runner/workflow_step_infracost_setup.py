@@ -1,10 +1,19 @@
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
 import json
 import logging
 import os
+import shutil
 import subprocess
+import time
 
+import cache
 import cmd
 import infracost
+import pricing_proxy
+import repo_config as rc
 import retry
 import workflow
 
@@ -23,7 +32,7 @@ def _retry_test(c, ret):
     return (proc.returncode == 0 and 'level=error' not in output)
 
 
-def _run_retry(state, c):
+def run_retry(state, c):
     proc, output = retry.run(
         lambda: cmd.run_with_output(state, {'cmd': c}),
         retry.finite_tries(TRIES, lambda ret: _retry_test(c, ret)),
@@ -35,75 +44,263 @@ def _run_retry(state, c):
     return output
 
 
-def _checkout_base(state):
-    current_branch = subprocess.check_output(['git', 'branch', '--show-current'],
-                                             cwd=state.working_dir)
-    subprocess.check_call(['git', 'branch'], cwd=state.working_dir)
-    # If they made any changes to the repo, stash it for now
-    subprocess.call(['git', 'stash', 'push'])
-    subprocess.check_call(['git', 'checkout', state.work_manifest['base_ref'], '--'],
+def _rev_parse(state, ref):
+    return subprocess.check_output(['git', 'rev-parse', '--verify', '--quiet', ref + '^{commit}'],
+                                   cwd=state.working_dir).decode('utf-8').strip()
+
+
+def _base_commit(state):
+    # The merge fetches the remote branch, but fall back to a local branch if
+    # there is no remote one.
+    base_ref = state.work_manifest['base_ref']
+    try:
+        return _rev_parse(state, 'origin/' + base_ref)
+    except subprocess.CalledProcessError:
+        return _rev_parse(state, base_ref)
+
+
+def _add_base_worktree(state, path):
+    # The base is checked out in a worktree of its own, so the working tree of
+    # the run is never modified and the base and head breakdowns can run at the
+    # same time.
+    subprocess.check_call(['git', 'worktree', 'add', '--detach', path, _base_commit(state)],
                           cwd=state.working_dir)
-    return current_branch.strip()
 
 
-def _configure_infracost(state, config):
+def _remove_base_worktree(state, path):
+    subprocess.call(['git', 'worktree', 'remove', '--force', path], cwd=state.working_dir)
+    subprocess.call(['git', 'worktree', 'prune'], cwd=state.working_dir)
+
+
+def configure_infracost(state, config):
     env = state.env
     if INFRACOST_API_KEY in env:
         logging.info('INFRACOST : SETUP : PUBLIC_ENDPOINT')
         state.run_time.set_secret(env[INFRACOST_API_KEY].strip())
-        _run_retry(state,
-                   ['infracost',
-                    'configure',
-                    'set',
-                    'api_key',
-                    env[INFRACOST_API_KEY].strip()])
+        run_retry(state,
+                  ['infracost',
+                   'configure',
+                   'set',
+                   'api_key',
+                   env[INFRACOST_API_KEY].strip()])
     else:
         logging.info('INFRACOST : SETUP : SELF_HOSTED_ENDPOINT')
-        _run_retry(state,
-                   ['infracost',
-                    'configure',
-                    'set',
-                    'pricing_api_endpoint',
-                    state.api_base_url + '/infracost'])
-        _run_retry(state,
-                   ['infracost',
-                    'configure',
-                    'set',
-                    'api_key',
-                    state.work_token])
-
-    _run_retry(state,
-               ['infracost',
-                'configure',
-                'set',
-                'currency',
-                env.get(INFRACOST_CURRENCY, config['currency'])])
-
-
-def _create_base_infracost(state, config, infracost_dir, infracost_json):
-    current_branch = _checkout_base(state)
+        run_retry(state,
+                  ['infracost',
+                   'configure',
+                   'set',
+                   'pricing_api_endpoint',
+                   state.api_base_url + '/infracost'])
+        run_retry(state,
+                  ['infracost',
+                   'configure',
+                   'set',
+                   'api_key',
+                   state.work_token])
+
+    run_retry(state,
+              ['infracost',
+               'configure',
+               'set',
+               'currency',
+               currency(state, config)])
+
+
+def currency(state, config):
+    return state.env.get(INFRACOST_CURRENCY, config['currency'])
+
+
+def _pricing_endpoint(state):
+    if INFRACOST_API_KEY in state.env:
+        return 'public'
+    else:
+        return state.api_base_url + '/infracost'
+
+
+def _base_cache_dir(state):
+    cache_config = rc.get_cost_estimation(state.repo_config)['cache']
+    return os.path.expanduser(cache_config['path']
+                              or os.path.join(cache.root(state.env), 'infracost'))
+
+
+@contextlib.contextmanager
+def pricing_cache(state):
+    """Run a caching proxy in front of the pricing API for the duration of the
+    context, yielding [state] with infracost configured to use it.
+
+    """
+    cache_config = rc.get_cost_estimation(state.repo_config)['cache']
+    if not cache_config['enabled']:
+        yield state
+        return
+
+    if pricing_proxy.PRICING_API_ENDPOINT_VAR in state.env:
+        upstream = state.env[pricing_proxy.PRICING_API_ENDPOINT_VAR]
+    elif INFRACOST_API_KEY in state.env:
+        upstream = pricing_proxy.PUBLIC_PRICING_API_ENDPOINT
+    else:
+        upstream = state.api_base_url + '/infracost'
+
+    with pricing_proxy.running(upstream,
+                               os.path.join(_base_cache_dir(state), 'pricing'),
+                               cache_config['ttl_hours'] * 60 * 60,
+                               cache_config['max_size_mb'] * 1024 * 1024) as endpoint:
+        env = state.env.copy()
+        # Takes precedence over the endpoint in the infracost configuration.
+        env[pricing_proxy.PRICING_API_ENDPOINT_VAR] = endpoint
+        yield state._replace(env=env)
+
+
+def _base_cache_key(state, config, config_yml):
+    # The base breakdown only changes if the base branch moves, the projects
+    # in it change, or prices could be different.
+    h = hashlib.sha256()
+    h.update(_base_commit(state).encode('utf-8'))
+    with open(config_yml, 'rb') as f:
+        h.update(f.read())
+    h.update(currency(state, config).encode('utf-8'))
+    h.update(subprocess.check_output(['infracost', '--version'], cwd=state.working_dir))
+    h.update(_pricing_endpoint(state).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _load_base_infracost(state, key, infracost_json):
+    cache_config = rc.get_cost_estimation(state.repo_config)['cache']
+    cached = os.path.join(_base_cache_dir(state), key + '.json')
+
     try:
-        infracost_config_yml = os.path.join(infracost_dir, 'config.yml')
+        age = time.time() - os.stat(cached).st_mtime
+    except FileNotFoundError:
+        logging.info('INFRACOST : BASE_CACHE : MISS : %s', key)
+        return False
+
+    # Prices change over time, so the cached breakdown is only used for so long.
+    if age > cache_config['ttl_hours'] * 60 * 60:
+        logging.info('INFRACOST : BASE_CACHE : EXPIRED : %s', key)
+        return False
+
+    shutil.copyfile(cached, infracost_json)
+    logging.info('INFRACOST : BASE_CACHE : HIT : %s', key)
+    return True
+
 
-        infracost.create_infracost_yml(infracost_config_yml, state.work_manifest['base_dirspaces'])
+def _save_base_infracost(state, key, infracost_json):
+    cache_config = rc.get_cost_estimation(state.repo_config)['cache']
+    cache_dir = _base_cache_dir(state)
+    cached = os.path.join(cache_dir, key + '.json')
+    tmp_path = '{}.{}.tmp'.format(cached, os.getpid())
 
-        _run_retry(state,
-                   ['infracost',
-                    'breakdown',
-                    '--config-file={}'.format(infracost_config_yml),
-                    '--format=json',
-                    '--out-file={}'.format(infracost_json)])
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.copyfile(infracost_json, tmp_path)
+    os.rename(tmp_path, cached)
 
-    finally:
-        subprocess.check_call(['git', 'checkout', current_branch, '--'], cwd=state.working_dir)
-        subprocess.call(['git', 'stash', 'pop'])
+    cache.evict(glob.glob(os.path.join(cache_dir, '*.json')),
+                cache_config['max_size_mb'] * 1024 * 1024)
+
+
+def _create_infracost(state, config_yml, infracost_json):
+    return run_retry(state,
+                     ['infracost',
+                      'breakdown',
+                      '--config-file={}'.format(config_yml),
+                      '--format=json',
+                      '--out-file={}'.format(infracost_json)])
 
 
 def _make_path_relative(base, path):
     return path.removeprefix(base + '/')
 
 
+def _result(state, outputs):
+    return workflow.Result(failed=False,
+                           state=state,
+                           workflow_step={'type': 'cost-estimation'},
+                           outputs=outputs)
+
+
+def empty_result(state, config):
+    """The result of a cost estimation with nothing to estimate."""
+    return _result(state,
+                   {
+                       'cost_estimation': {
+                           'prev_monthly_cost': 0.0,
+                           'total_monthly_cost': 0.0,
+                           'diff_monthly_cost': 0.0,
+                           'currency': currency(state, config),
+                           'dirspaces': []
+                       },
+                   })
+
+
+def diff_result(state, output, diff_infracost, dirspace_of_project):
+    """Turn the diff in [diff_infracost] into the result of a cost estimation.
+    [output] is the output of the infracost run, an error in it is reported
+    instead.  [dirspace_of_project] returns the (path, workspace) of a project
+    in the diff, or None if it is not to be reported.
+
+    """
+    if 'level=error' in output:
+        return _result(state, {'text': output})
+
+    with open(diff_infracost) as f:
+        diff = json.load(f)
+
+    try:
+        dirspaces = []
+        for p in diff['projects']:
+            dirspace = dirspace_of_project(p)
+            if dirspace:
+                path, workspace = dirspace
+                dirspaces.append({
+                    'path': path,
+                    'workspace': workspace,
+                    'prev_monthly_cost': infracost.convert_cost(p['pastBreakdown']['totalMonthlyCost']),
+                    'total_monthly_cost': infracost.convert_cost(p['breakdown']['totalMonthlyCost']),
+                    'diff_monthly_cost': infracost.convert_cost(p['diff']['totalMonthlyCost'])
+                })
+
+        return _result(state,
+                       {
+                           'cost_estimation': {
+                               'prev_monthly_cost': infracost.convert_cost(diff['pastTotalMonthlyCost']),
+                               'total_monthly_cost': infracost.convert_cost(diff['totalMonthlyCost']),
+                               'diff_monthly_cost': infracost.convert_cost(diff['diffTotalMonthlyCost']),
+                               'currency': diff['currency'],
+                               'dirspaces': dirspaces
+                           },
+                       })
+    except Exception as exn:
+        return _result(state, {'text': str(exn)})
+
+
+def run_cost_estimation(state, f):
+    """Run the cost estimation [f], which is given the state and returns a
+    result, with the pricing cache in front of it.  A failed infracost command
+    is reported in the result rather than failing the step.
+
+    """
+    with pricing_cache(state) as proxied_state:
+        try:
+            result = f(proxied_state)
+        except subprocess.CalledProcessError as exn:
+            logging.exception('INFRACOST : ERROR')
+            logging.error('%s', exn.stdout)
+
+            if exn.stdout is None:
+                text = 'See action output'
+            else:
+                text = exn.stdout
+
+            result = _result(proxied_state, {'text': text})
+
+    return result._replace(state=state)
+
+
 def run(state, config):
+    return run_cost_estimation(state, lambda proxied_state: _run(proxied_state, config))
+
+
+def _run(state, config):
     infracost_dir = os.path.join(state.tmpdir, 'infracost')
     os.makedirs(infracost_dir, exist_ok=True)
 
@@ -111,87 +308,60 @@ def run(state, config):
     curr_infracost = os.path.join(infracost_dir, 'infracost.json')
     diff_infracost = os.path.join(infracost_dir, 'infracost-diff.json')
     infracost_config_yml = os.path.join(infracost_dir, 'config.yml')
+    base_infracost_config_yml = os.path.join(infracost_dir, 'config-prev.yml')
+    base_dir = os.path.join(infracost_dir, 'base')
 
-    try:
-        logging.info('INFRACOST : SETUP')
-        _configure_infracost(state, config)
-
-        _create_base_infracost(state, config, infracost_dir, prev_infracost)
-
-        infracost.create_infracost_yml(infracost_config_yml, state.work_manifest['dirspaces'])
-
-        output = _run_retry(state,
-                            ['infracost',
-                             'breakdown',
-                             '--config-file={}'.format(infracost_config_yml),
-                             '--format=json',
-                             '--out-file={}'.format(curr_infracost)])
-
-        _run_retry(state,
-                   ['infracost',
-                    'diff',
-                    '--format=json',
-                    '--path={}'.format(curr_infracost),
-                    '--compare-to={}'.format(prev_infracost),
-                    '--out-file={}'.format(diff_infracost)])
-
-        if 'level=error' not in output:
-            with open(diff_infracost) as f:
-                diff = json.load(f)
-
-            changed_dirspaces = set([(ds['path'], ds['workspace'])
-                                     for ds in state.work_manifest['changed_dirspaces']])
-
-            try:
-                dirspaces = [
-                    {
-                        'path': _make_path_relative(state.working_dir, p['metadata']['path']),
-                        'workspace': p['metadata']['terraformWorkspace'],
-                        'prev_monthly_cost': infracost.convert_cost(p['pastBreakdown']['totalMonthlyCost']),
-                        'total_monthly_cost': infracost.convert_cost(p['breakdown']['totalMonthlyCost']),
-                        'diff_monthly_cost': infracost.convert_cost(p['diff']['totalMonthlyCost'])
-                    }
-                    for p in diff['projects']
-                    if (_make_path_relative(state.working_dir,
-                                            p['metadata']['path']),
-                        p['metadata']['terraformWorkspace']) in changed_dirspaces
-                ]
-
-                return workflow.Result(
-                    failed=False,
-                    state=state,
-                    workflow_step={'type': 'cost-estimation'},
-                    outputs={
-                        'cost_estimation': {
-                            'prev_monthly_cost': infracost.convert_cost(diff['pastTotalMonthlyCost']),
-                            'total_monthly_cost': infracost.convert_cost(diff['totalMonthlyCost']),
-                            'diff_monthly_cost': infracost.convert_cost(diff['diffTotalMonthlyCost']),
-                            'currency': diff['currency'],
-                            'dirspaces': dirspaces
-                        },
-                    })
-            except Exception as exn:
-                return workflow.Result(
-                    failed=False,
-                    state=state,
-                    workflow_step={'type': 'cost-estimation'},
-                    outputs={'text': str(exn)})
-        else:
-            return workflow.Result(failed=False,
-                                   state=state,
-                                   workflow_step={'type': 'cost-estimation'},
-                                   outputs={'text': output})
+    logging.info('INFRACOST : SETUP')
+    configure_infracost(state, config)
 
-    except subprocess.CalledProcessError as exn:
-        logging.exception('INFRACOST : ERROR')
-        logging.error('%s', exn.stdout)
+    infracost.create_infracost_yml(base_infracost_config_yml,
+                                   state.work_manifest['base_dirspaces'])
+    infracost.create_infracost_yml(infracost_config_yml, state.work_manifest['dirspaces'])
 
-        if exn.stdout is None:
-            text = 'See action output'
+    base_cache_key = None
+    if rc.get_cost_estimation(state.repo_config)['cache']['enabled']:
+        base_cache_key = _base_cache_key(state, config, base_infracost_config_yml)
+
+    if base_cache_key and _load_base_infracost(state, base_cache_key, prev_infracost):
+        output = _create_infracost(state, infracost_config_yml, curr_infracost)
+    else:
+        _add_base_worktree(state, base_dir)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                base = executor.submit(_create_infracost,
+                                       state._replace(working_dir=base_dir),
+                                       base_infracost_config_yml,
+                                       prev_infracost)
+                curr = executor.submit(_create_infracost,
+                                       state,
+                                       infracost_config_yml,
+                                       curr_infracost)
+                base_output = base.result()
+                output = curr.result()
+        finally:
+            _remove_base_worktree(state, base_dir)
+
+        # A breakdown with errors in it is not worth keeping.
+        if base_cache_key and 'level=error' not in base_output:
+            _save_base_infracost(state, base_cache_key, prev_infracost)
+
+    run_retry(state,
+              ['infracost',
+               'diff',
+               '--format=json',
+               '--path={}'.format(curr_infracost),
+               '--compare-to={}'.format(prev_infracost),
+               '--out-file={}'.format(diff_infracost)])
+
+    changed_dirspaces = set([(ds['path'], ds['workspace'])
+                             for ds in state.work_manifest['changed_dirspaces']])
+
+    def _dirspace_of_project(p):
+        dirspace = (_make_path_relative(state.working_dir, p['metadata']['path']),
+                    p['metadata']['terraformWorkspace'])
+        if dirspace in changed_dirspaces:
+            return dirspace
         else:
-            text = exn.stdout
+            return None
 
-        return workflow.Result(failed=False,
-                               state=state,
-                               workflow_step={'type': 'cost-estimation'},
-                               outputs={'text': text})
+    return diff_result(state, output, diff_infracost, _dirspace_of_project)
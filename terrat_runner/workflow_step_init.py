@@ -1,6 +1,10 @@
+import logging
 import os
 import shutil
 
+import init_cache
+import plugin_cache
+import provider_mirror
 import retry
 import workflow_step_terraform
 
@@ -9,6 +13,18 @@ INITIAL_SLEEP = 1
 BACKOFF = 1.5
 
 
+def _run_init(state, config):
+    with provider_mirror.lock(state.env), plugin_cache.lock(state) as state:
+        return workflow_step_terraform.run(state, config)
+
+
+def _run_init_retry(state, config, tries=TRIES):
+    return retry.run(
+        lambda: _run_init(state, config),
+        retry.finite_tries(tries, lambda result: not result.failed),
+        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
+
+
 def run(state, config):
     original_config = config
     config = original_config.copy()
@@ -22,9 +38,32 @@ def run(state, config):
 
     state = state.run_time.update_authentication(state)
 
-    result = retry.run(
-        lambda: workflow_step_terraform.run(state, config),
-        retry.finite_tries(TRIES, lambda result: not result.failed),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
+    fingerprint = None
+    if init_cache.enabled(state):
+        fingerprint = init_cache.fingerprint(state, config)
+
+    if fingerprint:
+        (state, hit) = init_cache.restore(state, fingerprint)
+        if hit:
+            # Modules are already installed, the init only has to check the
+            # backend and the providers.
+            config['args'] = ['init', '-get=false']
+
+    if config['args'] == ['init']:
+        result = _run_init_retry(state, config)
+    else:
+        # A failure is more likely to be the restored data dir than something
+        # transient, so do not try the cached init again.
+        result = _run_init_retry(state, config, tries=1)
+
+    if result.failed and config['args'] != ['init']:
+        # Start again from scratch, for example a module may not be installed.
+        logging.warning('INIT : CACHED_INIT_FAILED : %s : %s', state.path, state.workspace)
+        shutil.rmtree(state.env[init_cache.DATA_DIR_VAR], ignore_errors=True)
+        config['args'] = ['init']
+        result = _run_init_retry(state, config)
+
+    if fingerprint and not result.failed and config['args'] == ['init']:
+        init_cache.save(state, fingerprint)
 
     return result._replace(workflow_step={'type': 'init'})
@@ -3,20 +3,15 @@ import json
 import logging
 import os
 import string
-import subprocess
 import time
 
 import requests
 
+import aws_sts
 import requests_retry
-import retry
 import workflow
 
 
-TRIES = 3
-INITIAL_SLEEP = 2
-BACKOFF = 1.5
-
 DEFAULT_AWS_AUDIENCE = 'sts.amazonaws.com'
 DEFAULT_DURATION = 3600
 DEFAULT_REGION = 'us-east-1'
@@ -25,107 +20,85 @@ DEFAULT_SESSION_NAME = 'terrateam'
 REQUEST_URL_VAR = 'ACTIONS_ID_TOKEN_REQUEST_URL'
 REQUEST_TOKEN_VAR = 'ACTIONS_ID_TOKEN_REQUEST_TOKEN'
 
+STS_ENDPOINT_VAR = 'AWS_ENDPOINT_URL_STS'
+
 
 class Auth_error(Exception):
     pass
 
 
+def _sts_endpoint(state, config):
+    return aws_sts.endpoint(state.env['AWS_REGION'],
+                            config.get('sts_endpoint', state.env.get(STS_ENDPOINT_VAR)))
+
+
+def _set_credentials(state, credentials):
+    env = state.env.copy()
+    env['AWS_ACCESS_KEY_ID'] = credentials['access_key_id']
+    env['AWS_SECRET_ACCESS_KEY'] = credentials['secret_access_key']
+    env['AWS_SESSION_TOKEN'] = credentials['session_token']
+    state.run_time.set_secret(env['AWS_ACCESS_KEY_ID'])
+    state.run_time.set_secret(env['AWS_SECRET_ACCESS_KEY'])
+    state.run_time.set_secret(env['AWS_SESSION_TOKEN'])
+    return state._replace(env=env)
+
+
 def assume_role_with_web_identity(state, config, web_identity_token):
     role_arn = string.Template(config['role_arn']).substitute(state.env)
     duration = config.get('duration', DEFAULT_DURATION)
     session_name = config.get('session_name', DEFAULT_SESSION_NAME)
 
-    proc = retry.run(
-        lambda: subprocess.run(
-            [
-                'aws',
-                'sts',
-                'assume-role-with-web-identity',
-                '--role-arn', role_arn,
-                '--role-session-name', session_name,
-                '--web-identity-token', web_identity_token,
-                '--duration-seconds', str(duration),
-                '--output', 'json'
-            ],
-            cwd=state.working_dir,
-            env=state.env,
-            capture_output=True
-        ),
-        retry.finite_tries(TRIES, lambda ret: ret.returncode == 0),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
-
-    if proc.returncode == 0:
-        output = json.loads(proc.stdout.decode('utf-8'))
-        env = state.env.copy()
-        env['AWS_ACCESS_KEY_ID'] = output['Credentials']['AccessKeyId']
-        env['AWS_SECRET_ACCESS_KEY'] = output['Credentials']['SecretAccessKey']
-        env['AWS_SESSION_TOKEN'] = output['Credentials']['SessionToken']
-        state.run_time.set_secret(env['AWS_ACCESS_KEY_ID'])
-        state.run_time.set_secret(env['AWS_SECRET_ACCESS_KEY'])
-        state.run_time.set_secret(env['AWS_SESSION_TOKEN'])
-        state = state._replace(env=env)
-
-        return workflow.Result(failed=False,
-                               state=state,
-                               workflow_step={'type': 'oidc'},
-                               outputs=None)
-    else:
-        logging.error('OIDC : %s : ERROR', role_arn)
+    try:
+        credentials = aws_sts.assume_role_with_web_identity(_sts_endpoint(state, config),
+                                                            role_arn,
+                                                            session_name,
+                                                            web_identity_token,
+                                                            duration)
+    except Exception as exn:
+        logging.error('OIDC : %s : ERROR : %s', role_arn, exn)
         return workflow.Result(failed=True,
                                state=state,
                                workflow_step={'type': 'oidc'},
                                outputs={
-                                   'text': proc.stderr.decode('utf-8')
+                                   'text': 'AssumeRoleWithWebIdentity failed: {}'.format(exn)
                                })
 
+    return workflow.Result(failed=False,
+                           state=_set_credentials(state, credentials),
+                           workflow_step={'type': 'oidc'},
+                           outputs=None)
+
 
 def assume_role(state, config):
     assume_role_arn = string.Template(config['assume_role_arn']).substitute(state.env)
     duration = config.get('duration', DEFAULT_DURATION)
     session_name = config.get('session_name', DEFAULT_SESSION_NAME)
 
-    proc = retry.run(
-        lambda: subprocess.run(
-            [
-                'aws',
-                'sts',
-                'assume-role',
-                '--role-arn', assume_role_arn,
-                '--role-session-name', session_name,
-                '--duration-seconds', str(duration),
-                '--output', 'json'
-            ],
-            cwd=state.working_dir,
-            env=state.env,
-            capture_output=True
-        ),
-        retry.finite_tries(TRIES, lambda ret: ret.returncode == 0),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
-
-    if proc.returncode == 0:
-        output = json.loads(proc.stdout.decode('utf-8'))
-        env = state.env.copy()
-        env['AWS_ACCESS_KEY_ID'] = output['Credentials']['AccessKeyId']
-        env['AWS_SECRET_ACCESS_KEY'] = output['Credentials']['SecretAccessKey']
-        env['AWS_SESSION_TOKEN'] = output['Credentials']['SessionToken']
-        state.run_time.set_secret(env['AWS_ACCESS_KEY_ID'])
-        state.run_time.set_secret(env['AWS_SECRET_ACCESS_KEY'])
-        state.run_time.set_secret(env['AWS_SESSION_TOKEN'])
-        state = state._replace(env=env)
-
-        return workflow.Result(failed=False,
-                               state=state,
-                               workflow_step={'type': 'oidc'},
-                               outputs=None)
-    else:
-        logging.error('OIDC : %s : ERROR', assume_role_arn)
+    try:
+        credentials = aws_sts.assume_role(_sts_endpoint(state, config),
+                                          state.env['AWS_REGION'],
+                                          {
+                                              'access_key_id': state.env['AWS_ACCESS_KEY_ID'],
+                                              'secret_access_key': state.env['AWS_SECRET_ACCESS_KEY'],
+                                              'session_token': state.env.get('AWS_SESSION_TOKEN'),
+                                          },
+                                          assume_role_arn,
+                                          session_name,
+                                          duration)
+    except Exception as exn:
+        logging.error('OIDC : %s : ERROR : %s', assume_role_arn, exn)
         return workflow.Result(failed=True,
                                state=state,
                                workflow_step={'type': 'oidc'},
                                outputs={
-                                   'text': proc.stdout.decode('utf-8') + '\n' + proc.stderr.decode('utf-8')
+                                   'text': 'AssumeRole failed: {}'.format(exn)
                                })
 
+    return workflow.Result(failed=False,
+                           state=_set_credentials(state, credentials),
+                           workflow_step={'type': 'oidc'},
+                           outputs=None)
+
 
 def run_aws(state, config):
     role_arn = string.Template(config['role_arn']).substitute(state.env)
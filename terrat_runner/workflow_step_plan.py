@@ -2,35 +2,243 @@ import base64
 import hashlib
 import logging
 
+import os
+import shutil
+
+import cache
+import content_encoding
+import repo_config as rc
 import requests_retry
+import workflow_step_infracost_plan_json
 import workflow_step_terraform
 
 
-def _store_plan(work_token, api_base_url, dir_path, workspace, plan_path, has_changes):
+# Versions of the API which only accept the plan as base64 in a JSON body
+# respond to a raw upload with one of these.
+RAW_UPLOAD_UNSUPPORTED_STATUS_CODES = [400, 404, 415]
+
+# The API responds with this if it does not support the content encoding of a
+# raw upload, listing those it does support in Accept-Encoding.
+ENCODING_UNSUPPORTED_STATUS_CODE = 415
+
+# How the API accepts plans is learned from the first upload of a run and
+# recorded in this file in the run's tmpdir, so every other dirspace uploads its
+# plan that way rather than sending it every way the API may reject.  It holds
+# the content encoding of a raw upload, or JSON_UPLOAD.
+UPLOAD_MODE_FILE = 'plan-upload-mode'
+
+JSON_UPLOAD = 'json'
+
+
+def _store_plan_raw(work_token,
+                    api_base_url,
+                    dir_path,
+                    workspace,
+                    plan_path,
+                    has_changes,
+                    encoding):
+    # Stream the plan file as the request body, hashing it as it is sent, so
+    # the plan is never held in memory.
+    body = requests_retry.File_body(plan_path, hashlib.md5)
+    headers = {'content-type': 'application/octet-stream'}
+
+    if encoding != content_encoding.IDENTITY:
+        headers['content-encoding'] = encoding
+        data = content_encoding.Encoded_body(encoding, body)
+    else:
+        data = body
+
+    res = requests_retry.post(api_base_url + '/v1/work-manifests/' + work_token + '/plans',
+                              params={
+                                  'path': dir_path,
+                                  'workspace': workspace,
+                                  'has_changes': 'true' if has_changes else 'false'
+                              },
+                              headers=headers,
+                              data=data)
+
+    logging.debug(('PLAN : STORE_PLAN : RAW : dir_path=%s : workspace=%s : md5=%s : '
+                   'encoding=%s : status_code=%d'),
+                  dir_path,
+                  workspace,
+                  body.hexdigest,
+                  encoding,
+                  res.status_code)
+
+    return res
+
+
+def _store_plan_json(work_token, api_base_url, dir_path, workspace, plan_path, has_changes):
+    with open(plan_path, 'rb') as f:
+        plan_raw_data = f.read()
+        plan_data = base64.b64encode(plan_raw_data).decode('utf-8')
+
+    logging.debug('PLAN : STORE_PLAN : JSON : dir_path=%s : workspace=%s : md5=%s',
+                  dir_path,
+                  workspace,
+                  hashlib.md5(plan_raw_data).hexdigest())
+
+    return requests_retry.post(api_base_url + '/v1/work-manifests/' + work_token + '/plans',
+                               json={
+                                   'path': dir_path,
+                                   'workspace': workspace,
+                                   'plan_data': plan_data,
+                                   'has_changes': has_changes
+                               })
+
+
+def _upload_mode_path(tmpdir):
+    return os.path.join(tmpdir, UPLOAD_MODE_FILE)
+
+
+def _read_upload_mode(tmpdir):
     try:
-        with open(plan_path, 'rb') as f:
-            plan_raw_data = f.read()
-            plan_data = base64.b64encode(plan_raw_data).decode('utf-8')
-
-        logging.debug('PLAN : STORE_PLAN : dir_path=%s : workspace=%s : md5=%s',
-                      dir_path,
-                      workspace,
-                      hashlib.md5(plan_raw_data).hexdigest())
-
-        res = requests_retry.post(api_base_url + '/v1/work-manifests/' + work_token + '/plans',
-                                  json={
-                                      'path': dir_path,
-                                      'workspace': workspace,
-                                      'plan_data': plan_data,
-                                      'has_changes': has_changes
-                                  })
+        with open(_upload_mode_path(tmpdir)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _write_upload_mode(tmpdir, mode):
+    path = _upload_mode_path(tmpdir)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(mode)
+
+    os.rename(tmp_path, path)
+
 
+def _store_plan_with_mode(work_token,
+                          api_base_url,
+                          dir_path,
+                          workspace,
+                          plan_path,
+                          has_changes,
+                          mode):
+    if mode == JSON_UPLOAD:
+        return _store_plan_json(work_token, api_base_url, dir_path, workspace, plan_path, has_changes)
+    else:
+        return _store_plan_raw(work_token,
+                               api_base_url,
+                               dir_path,
+                               workspace,
+                               plan_path,
+                               has_changes,
+                               mode)
+
+
+def _accepted_encoding(res, rejected):
+    # An API which does not support the content encoding of a request lists the
+    # ones it does in the Accept-Encoding of its response, if it supports any.
+    accepted = [e.split(';')[0].strip().lower()
+                for e in res.headers.get('accept-encoding', '').split(',')]
+    for encoding in content_encoding.supported():
+        if encoding != rejected and encoding in accepted:
+            return encoding
+
+    return content_encoding.IDENTITY
+
+
+def _store_plan_negotiate(work_token, api_base_url, dir_path, workspace, plan_path, has_changes):
+    """Upload the plan, finding out how the API accepts plans as it goes.
+    Returns the response and the upload mode.  The plan is sent with our
+    preferred encoding and, if the API does not support it, once more with an
+    encoding the API says it does support, or none.
+
+    """
+    encoding = content_encoding.supported()[0]
+    res = _store_plan_raw(work_token,
+                          api_base_url,
+                          dir_path,
+                          workspace,
+                          plan_path,
+                          has_changes,
+                          encoding)
+
+    if res.status_code == ENCODING_UNSUPPORTED_STATUS_CODE:
+        rejected = encoding
+        encoding = _accepted_encoding(res, rejected)
+        logging.info('PLAN : STORE_PLAN : ENCODING_UNSUPPORTED : %s : using=%s', rejected, encoding)
+        res = _store_plan_raw(work_token,
+                              api_base_url,
+                              dir_path,
+                              workspace,
+                              plan_path,
+                              has_changes,
+                              encoding)
+
+    if res.status_code in RAW_UPLOAD_UNSUPPORTED_STATUS_CODES:
+        logging.info('PLAN : STORE_PLAN : RAW_UNSUPPORTED : status_code=%d', res.status_code)
+        res = _store_plan_json(work_token,
+                               api_base_url,
+                               dir_path,
+                               workspace,
+                               plan_path,
+                               has_changes)
+        return (res, JSON_UPLOAD)
+
+    return (res, encoding)
+
+
+def _store_plan(tmpdir, work_token, api_base_url, dir_path, workspace, plan_path, has_changes):
+    try:
+        mode = _read_upload_mode(tmpdir)
+        if mode is None:
+            # Only one dirspace at a time finds out how to upload, the others
+            # wait for its answer rather than each sending their plan every way.
+            with cache.lock(_upload_mode_path(tmpdir) + '.lock'):
+                mode = _read_upload_mode(tmpdir)
+                if mode is None:
+                    res, mode = _store_plan_negotiate(work_token,
+                                                      api_base_url,
+                                                      dir_path,
+                                                      workspace,
+                                                      plan_path,
+                                                      has_changes)
+                    if res.status_code == 200:
+                        logging.info('PLAN : STORE_PLAN : UPLOAD_MODE : %s', mode)
+                        _write_upload_mode(tmpdir, mode)
+
+                    return res.status_code == 200
+
+        res = _store_plan_with_mode(work_token,
+                                    api_base_url,
+                                    dir_path,
+                                    workspace,
+                                    plan_path,
+                                    has_changes,
+                                    mode)
         return res.status_code == 200
     except Exception as exn:
         print('Failed: {}'.format(exn))
         return False
 
 
+def _cost_estimation_from_plan_json(repo_config):
+    cost_estimation_config = rc.get_cost_estimation(repo_config)
+    return cost_estimation_config['enabled'] and cost_estimation_config['source'] == 'plan_json'
+
+
+def _store_cost_estimation_plan_json(state):
+    # The JSON goes to TERRATEAM_PLAN_JSON_FILE, so later steps of the dirspace
+    # can use it, and a copy is kept for cost estimation after all dirspaces
+    # have run.
+    plan_json = state.env['TERRATEAM_PLAN_JSON_FILE']
+    if not workflow_step_terraform.write_plan_json(state, plan_json):
+        logging.error('PLAN : COST_ESTIMATION : PLAN_JSON_FAILED : %s : %s',
+                      state.path,
+                      state.workspace)
+        return
+
+    dest = workflow_step_infracost_plan_json.plan_json_path(state,
+                                                            {
+                                                                'path': state.path,
+                                                                'workspace': state.workspace,
+                                                            })
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    shutil.copyfile(plan_json, dest)
+
+
 def run(state, config):
     config = config.copy()
     config['args'] = ['plan', '-detailed-exitcode', '-out', '$TERRATEAM_PLAN_FILE']
@@ -66,7 +274,14 @@ def run(state, config):
     outputs['plan_text'] = result.outputs['text']
     outputs['has_changes'] = has_changes
 
-    success = _store_plan(state.work_token,
+    # Keep the rendered plan next to the plan file so that later steps can use
+    # it without running terraform show again.
+    if 'TERRATEAM_PLAN_TEXT_FILE' in state.env:
+        with open(state.env['TERRATEAM_PLAN_TEXT_FILE'], 'w') as f:
+            f.write(outputs['plan_text'])
+
+    success = _store_plan(state.tmpdir,
+                          state.work_token,
                           state.api_base_url,
                           state.env['TERRATEAM_DIR'],
                           state.env['TERRATEAM_WORKSPACE'],
@@ -74,5 +289,15 @@ def run(state, config):
                           has_changes)
     result = result._replace(failed=not success)
 
+    if has_changes and _cost_estimation_from_plan_json(state.repo_config):
+        # Cost estimation is best effort, failing to produce its input must not
+        # fail the plan.
+        try:
+            _store_cost_estimation_plan_json(state)
+        except Exception:
+            logging.exception('PLAN : COST_ESTIMATION : PLAN_JSON_FAILED : %s : %s',
+                              state.path,
+                              state.workspace)
+
     return result._replace(workflow_step={'type': 'plan'},
                            outputs=outputs)
@@ -8,6 +8,12 @@ RUN_ON_SUCCESS = 'success'
 RUN_ON_FAILURE = 'failure'
 RUN_ON_ALWAYS = 'always'
 
+# Captured output longer than this many characters only has its start and end
+# kept, so a very chatty command cannot use unbounded memory.
+MAX_OUTPUT_SIZE = 10 * 1024 * 1024
+
+OUTPUT_TRUNCATED = '\n\n[... output truncated ...]\n\n'
+
 
 def run(state, config):
     ignore_errors = config.get('ignore_errors', False)
@@ -32,7 +38,10 @@ def run(state, config):
             # Only capture output if we want to save it somewhere or we have
             # explicitly enabled it.
             if output_key is not None or capture_output:
-                proc, stdout = cmd.run_with_output(state, config)
+                proc, output = cmd.run_with_output_handle(state, config)
+                with output:
+                    stdout = output.read_bounded(MAX_OUTPUT_SIZE, OUTPUT_TRUNCATED)
+
                 if output_key:
                     outputs = {'output_key': output_key, 'text': stdout}
                 else:
@@ -2,6 +2,7 @@ import os
 import json
 
 import cmd
+import terraform_install
 import workflow_step_run
 import workflow
 
@@ -36,18 +37,29 @@ def get_cdktf_working_dir(state):
     return working_dir
 
 
-def run_terraform(state, config):
-    args = config['args']
-    terraform_bin_path = os.path.join('/usr', 'local', 'bin', 'terraform')
-
-    env = config.get('env', {})
+def _terraform_cmd(state, env):
+    terraform_bin_path = terraform_install.install(state, state.env['TERRATEAM_TERRAFORM_VERSION'])
 
     if state.workflow['terragrunt']:
-        cmd = ['terragrunt']
         env = env.copy()
         env['TERRAGRUNT_TFPATH'] = terraform_bin_path
+        return (['terragrunt'], env)
     else:
-        cmd = [terraform_bin_path]
+        return ([terraform_bin_path], env)
+
+
+def run_terraform(state, config):
+    args = config['args']
+
+    try:
+        (cmd, env) = _terraform_cmd(state, config.get('env', {}))
+    except Exception as exn:
+        return workflow.Result(failed=True,
+                               state=state,
+                               workflow_step={'type': 'run'},
+                               outputs={'text': 'Failed to install Terraform {}: {}'.format(
+                                   state.env['TERRATEAM_TERRAFORM_VERSION'],
+                                   exn)})
 
     extra_args = config.get('extra_args', [])
     config = {
@@ -58,6 +70,33 @@ def run_terraform(state, config):
     return workflow_step_run.run(state, config)
 
 
+def write_plan_json(state, dest):
+    """Write the JSON of the plan in TERRATEAM_PLAN_FILE to [dest], without
+    capturing it as output.  Returns True on success.
+
+    """
+    (tf_cmd, env) = _terraform_cmd(state, {})
+
+    if state.workflow['cdktf']:
+        state = state._replace(working_dir=get_cdktf_working_dir(state))
+
+    tmp_path = dest + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        proc = cmd.run(state,
+                       {
+                           'cmd': tf_cmd + ['show', '-json', '$TERRATEAM_PLAN_FILE'],
+                           'env': env,
+                       },
+                       stdout=f)
+
+    if proc.returncode != 0:
+        os.unlink(tmp_path)
+        return False
+
+    os.rename(tmp_path, dest)
+    return True
+
+
 def update_result_working_dir(result, working_dir):
     return result._replace(state=result.state._replace(working_dir=working_dir))
 
@@ -0,0 +1,71 @@
+import http.server
+import threading
+
+import pytest
+
+
+class Stand_in(object):
+    """A local HTTP server standing in for an API.  Requests are recorded in
+    [requests] as (method, path, headers, body), with the header names in lower
+    case, and answered by [respond], which is given the same and returns
+    (status_code, headers, body).
+
+    """
+    def __init__(self):
+        self.requests = []
+        self.respond = lambda method, path, headers, body: (404, {}, b'')
+        self.url = None
+
+
+def _make_handler(stand_in):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _read_body(self):
+            if self.headers.get('transfer-encoding') == 'chunked':
+                body = b''
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    chunk = self.rfile.read(size + 2)[:size]
+                    if not size:
+                        return body
+                    body += chunk
+            else:
+                return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+        def _handle(self):
+            headers = {k.lower(): v for k, v in self.headers.items()}
+            request = (self.command, self.path, headers, self._read_body())
+            stand_in.requests.append(request)
+            status_code, headers, body = stand_in.respond(*request)
+            self.send_response(status_code)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = _handle
+        do_POST = _handle
+        do_PUT = _handle
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def stand_in():
+    s = Stand_in()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(s))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    s.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        yield s
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,194 @@
+import datetime
+import urllib.parse
+
+import pytest
+
+import aws_sts
+
+
+CREDENTIALS_RESPONSE = '''<{action}Response xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <{action}Result>
+    <Credentials>
+      <AccessKeyId>{name}-key</AccessKeyId>
+      <SecretAccessKey>{name}-secret</SecretAccessKey>
+      <SessionToken>{name}-token</SessionToken>
+      <Expiration>2030-01-01T00:00:00Z</Expiration>
+    </Credentials>
+  </{action}Result>
+</{action}Response>'''
+
+ERROR_RESPONSE = '''<ErrorResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <Error>
+    <Type>Sender</Type>
+    <Code>{code}</Code>
+    <Message>{message}</Message>
+  </Error>
+</ErrorResponse>'''
+
+
+def _xml(status_code, s):
+    return (status_code, {'content-type': 'text/xml'}, s.encode('utf-8'))
+
+
+def _params(body):
+    return dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(aws_sts, 'INITIAL_SLEEP', 0)
+
+
+def test_sign_matches_aws_test_suite(monkeypatch):
+    # The post-x-www-form-urlencoded case of the AWS Signature Version 4 test
+    # suite.
+    monkeypatch.setattr(aws_sts, 'SERVICE', 'service')
+    monkeypatch.setattr(aws_sts, 'CONTENT_TYPE', 'application/x-www-form-urlencoded')
+    headers = aws_sts._sign('https://example.amazonaws.com/',
+                            'us-east-1',
+                            {
+                                'access_key_id': 'AKIDEXAMPLE',
+                                'secret_access_key': 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+                            },
+                            b'Param1=value1',
+                            datetime.datetime(2015, 8, 30, 12, 36, 0, tzinfo=datetime.timezone.utc))
+
+    assert headers['x-amz-date'] == '20150830T123600Z'
+    assert headers['authorization'] == (
+        'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, '
+        'SignedHeaders=content-type;host;x-amz-date, '
+        'Signature=ff11897932ad3f4e8b18135d722051e5ac45fc38421b1da7b9d196a0fe09473a')
+
+
+def test_sign_includes_session_token():
+    headers = aws_sts._sign('https://sts.us-east-1.amazonaws.com/',
+                            'us-east-1',
+                            {
+                                'access_key_id': 'key',
+                                'secret_access_key': 'secret',
+                                'session_token': 'token',
+                            },
+                            b'',
+                            datetime.datetime.now(datetime.timezone.utc))
+
+    assert headers['x-amz-security-token'] == 'token'
+    assert 'SignedHeaders=content-type;host;x-amz-date;x-amz-security-token,' in headers['authorization']
+
+
+def test_endpoint():
+    assert aws_sts.endpoint('us-west-2') == 'https://sts.us-west-2.amazonaws.com'
+    assert aws_sts.endpoint('cn-north-1') == 'https://sts.cn-north-1.amazonaws.com.cn'
+    assert aws_sts.endpoint('us-west-2', 'http://localhost:1234') == 'http://localhost:1234'
+
+
+def test_assume_role_with_web_identity(stand_in):
+    stand_in.respond = lambda method, path, headers, body: _xml(
+        200,
+        CREDENTIALS_RESPONSE.format(action='AssumeRoleWithWebIdentity', name='web'))
+
+    credentials = aws_sts.assume_role_with_web_identity(stand_in.url + '/',
+                                                        'arn:aws:iam::123456789012:role/r',
+                                                        'session',
+                                                        'jwt',
+                                                        3600)
+
+    assert credentials == {
+        'access_key_id': 'web-key',
+        'secret_access_key': 'web-secret',
+        'session_token': 'web-token',
+    }
+
+    [(method, _, headers, body)] = stand_in.requests
+    assert method == 'POST'
+    # Exchanging a web identity is not signed.
+    assert 'authorization' not in headers
+    assert _params(body) == {
+        'Action': 'AssumeRoleWithWebIdentity',
+        'Version': aws_sts.API_VERSION,
+        'RoleArn': 'arn:aws:iam::123456789012:role/r',
+        'RoleSessionName': 'session',
+        'WebIdentityToken': 'jwt',
+        'DurationSeconds': '3600',
+    }
+
+
+def test_assume_role_is_signed(stand_in):
+    stand_in.respond = lambda method, path, headers, body: _xml(
+        200,
+        CREDENTIALS_RESPONSE.format(action='AssumeRole', name='role'))
+
+    credentials = aws_sts.assume_role(stand_in.url + '/',
+                                      'us-east-1',
+                                      {
+                                          'access_key_id': 'web-key',
+                                          'secret_access_key': 'web-secret',
+                                          'session_token': 'web-token',
+                                      },
+                                      'arn:aws:iam::123456789012:role/other',
+                                      'session',
+                                      900)
+
+    assert credentials['access_key_id'] == 'role-key'
+
+    [(_, _, headers, body)] = stand_in.requests
+    assert headers['authorization'].startswith(
+        'AWS4-HMAC-SHA256 Credential=web-key/')
+    assert '/us-east-1/sts/aws4_request' in headers['authorization']
+    assert headers['x-amz-security-token'] == 'web-token'
+    assert _params(body)['Action'] == 'AssumeRole'
+
+
+def test_error_is_parsed_and_not_retried(stand_in):
+    stand_in.respond = lambda method, path, headers, body: _xml(
+        403,
+        ERROR_RESPONSE.format(code='AccessDenied', message='Not authorized'))
+
+    with pytest.raises(aws_sts.Sts_error) as exn:
+        aws_sts.assume_role_with_web_identity(stand_in.url + '/', 'arn', 'session', 'jwt', 3600)
+
+    assert exn.value.code == 'AccessDenied'
+    assert exn.value.message == 'Not authorized'
+    assert len(stand_in.requests) == 1
+
+
+def test_error_which_is_not_xml(stand_in):
+    stand_in.respond = lambda method, path, headers, body: (403, {}, b'Forbidden')
+
+    with pytest.raises(aws_sts.Sts_error) as exn:
+        aws_sts.assume_role_with_web_identity(stand_in.url + '/', 'arn', 'session', 'jwt', 3600)
+
+    assert exn.value.code == '403'
+    assert exn.value.message == 'Forbidden'
+
+
+def test_throttling_is_retried(stand_in):
+    def _respond(method, path, headers, body):
+        if len(stand_in.requests) < aws_sts.TRIES:
+            return _xml(400, ERROR_RESPONSE.format(code='Throttling', message='Rate exceeded'))
+        else:
+            return _xml(200,
+                        CREDENTIALS_RESPONSE.format(action='AssumeRoleWithWebIdentity',
+                                                    name='web'))
+
+    stand_in.respond = _respond
+
+    credentials = aws_sts.assume_role_with_web_identity(stand_in.url + '/',
+                                                        'arn',
+                                                        'session',
+                                                        'jwt',
+                                                        3600)
+
+    assert credentials['access_key_id'] == 'web-key'
+    assert len(stand_in.requests) == aws_sts.TRIES
+
+
+def test_throttling_gives_up(stand_in):
+    stand_in.respond = lambda method, path, headers, body: _xml(
+        400,
+        ERROR_RESPONSE.format(code='Throttling', message='Rate exceeded'))
+
+    with pytest.raises(aws_sts.Sts_error) as exn:
+        aws_sts.assume_role_with_web_identity(stand_in.url + '/', 'arn', 'session', 'jwt', 3600)
+
+    assert exn.value.code == 'Throttling'
+    assert len(stand_in.requests) == aws_sts.TRIES
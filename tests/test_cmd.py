@@ -0,0 +1,34 @@
+import cmd
+
+
+def _output(s, threshold):
+    output = cmd.Output(threshold=threshold)
+    for idx in range(0, len(s), 7):
+        output.write(s[idx:idx + 7])
+    return output
+
+
+def test_read_bounded_returns_short_output():
+    with _output('hello world', threshold=1024) as output:
+        assert output.read_bounded(100, '...') == 'hello world'
+
+
+def test_read_bounded_keeps_start_and_end():
+    s = ''.join(str(idx % 10) for idx in range(1000))
+    for threshold in [10 * 1024, 100]:
+        # Both in memory and spilled to a file.
+        with _output(s, threshold) as output:
+            assert output.read_bounded(100, '...') == s[:50] + '...' + s[-50:]
+            # The output can still be written to after reading.
+            output.write('end')
+            assert output.read().endswith('end')
+
+
+def test_spills_to_file(tmp_path):
+    with cmd.Output(tmpdir=str(tmp_path), threshold=10) as output:
+        output.write('a' * 5)
+        assert not output._spilled
+        output.write('b' * 10)
+        assert output._spilled
+        assert output.read() == 'a' * 5 + 'b' * 10
+        assert len(output) == 15
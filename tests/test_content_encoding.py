@@ -0,0 +1,220 @@
+import base64
+import gzip
+import json
+import os
+import urllib.parse
+
+import pytest
+
+import content_encoding
+import requests_retry
+import work_apply
+import workflow_step_plan
+
+
+PLAN = os.urandom(64 * 1024) + b'plan' * (256 * 1024)
+
+
+@pytest.fixture
+def plan_path(tmp_path):
+    path = tmp_path / 'plan'
+    path.write_bytes(PLAN)
+    return str(path)
+
+
+def _decode(headers, body):
+    return b''.join(content_encoding.decompress(headers.get('content-encoding'), [body]))
+
+
+def _store_plan(stand_in, tmp_path, plan_path, dir_path='dir', has_changes=True):
+    return workflow_step_plan._store_plan(str(tmp_path),
+                                          'token',
+                                          stand_in.url,
+                                          dir_path,
+                                          'default',
+                                          plan_path,
+                                          has_changes)
+
+
+def _query(path):
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query))
+
+
+@pytest.mark.parametrize('encoding', content_encoding.supported() + [content_encoding.IDENTITY])
+def test_round_trip(encoding):
+    chunks = [PLAN[i:i + 1000] for i in range(0, len(PLAN), 1000)]
+    compressed = b''.join(content_encoding.compress(encoding, chunks))
+    assert b''.join(content_encoding.decompress(encoding, [compressed])) == PLAN
+
+
+def test_encoded_body_can_be_iterated_again(plan_path):
+    body = content_encoding.Encoded_body(content_encoding.GZIP, requests_retry.File_body(plan_path))
+    assert gzip.decompress(b''.join(body)) == PLAN
+    # A retried request sends the body again.
+    assert gzip.decompress(b''.join(body)) == PLAN
+
+
+def test_store_plan_uses_preferred_encoding(stand_in, tmp_path, plan_path):
+    stand_in.respond = lambda method, path, headers, body: (200, {}, b'')
+
+    assert _store_plan(stand_in, tmp_path, plan_path)
+
+    [(method, path, headers, body)] = stand_in.requests
+    assert headers['content-encoding'] == content_encoding.supported()[0]
+    assert headers['content-type'] == 'application/octet-stream'
+    assert _decode(headers, body) == PLAN
+    assert _query(path) == {
+        'path': 'dir',
+        'workspace': 'default',
+        'has_changes': 'true',
+    }
+
+
+def test_store_plan_falls_back_to_identity_on_415(stand_in, tmp_path, plan_path):
+    def _respond(method, path, headers, body):
+        if 'content-encoding' in headers:
+            return (415, {}, b'')
+        else:
+            return (200, {}, b'')
+
+    stand_in.respond = _respond
+
+    assert _store_plan(stand_in, tmp_path, plan_path, has_changes=False)
+
+    uploads = stand_in.requests
+    assert ([headers.get('content-encoding', content_encoding.IDENTITY)
+             for _, _, headers, _ in uploads]
+            == [content_encoding.supported()[0], content_encoding.IDENTITY])
+
+    _, _, headers, body = uploads[-1]
+    assert body == PLAN
+
+
+def test_store_plan_uses_encoding_from_415(monkeypatch, stand_in, tmp_path, plan_path):
+    pytest.importorskip('zstandard')
+    monkeypatch.setattr(content_encoding,
+                        'supported',
+                        lambda: [content_encoding.ZSTD, content_encoding.GZIP])
+
+    def _respond(method, path, headers, body):
+        if headers.get('content-encoding') == content_encoding.GZIP:
+            return (200, {}, b'')
+        else:
+            return (415, {'accept-encoding': 'br, gzip;q=0.5'}, b'')
+
+    stand_in.respond = _respond
+
+    assert _store_plan(stand_in, tmp_path, plan_path, dir_path='a')
+    assert _store_plan(stand_in, tmp_path, plan_path, dir_path='b')
+
+    assert ([headers.get('content-encoding') for _, _, headers, _ in stand_in.requests]
+            == [content_encoding.ZSTD, content_encoding.GZIP, content_encoding.GZIP])
+
+
+def test_store_plan_learns_encoding_once(stand_in, tmp_path, plan_path):
+    def _respond(method, path, headers, body):
+        if 'content-encoding' in headers:
+            return (415, {'accept-encoding': 'identity'}, b'')
+        else:
+            return (200, {}, b'')
+
+    stand_in.respond = _respond
+
+    assert _store_plan(stand_in, tmp_path, plan_path, dir_path='a')
+    assert len(stand_in.requests) == 2
+    assert _store_plan(stand_in, tmp_path, plan_path, dir_path='b')
+
+    # The second plan is sent once, unencoded.
+    [(_, path, headers, body)] = stand_in.requests[2:]
+    assert 'content-encoding' not in headers
+    assert _query(path)['path'] == 'b'
+    assert body == PLAN
+
+
+def test_store_plan_falls_back_to_json_upload(stand_in, tmp_path, plan_path):
+    def _respond(method, path, headers, body):
+        if 'content-encoding' in headers:
+            return (415, {}, b'')
+        elif headers.get('content-type') == 'application/octet-stream':
+            # An API which does not support raw uploads at all.
+            return (400, {}, b'')
+        else:
+            return (200, {}, b'')
+
+    stand_in.respond = _respond
+
+    assert _store_plan(stand_in, tmp_path, plan_path)
+
+    _, _, headers, body = stand_in.requests[-1]
+    assert headers['content-type'] == 'application/json'
+    assert base64.b64decode(json.loads(body)['plan_data']) == PLAN
+
+
+def test_store_plan_learns_upload_mode_once(stand_in, tmp_path, plan_path):
+    def _respond(method, path, headers, body):
+        if headers.get('content-type') == 'application/octet-stream':
+            return (400, {}, b'')
+        else:
+            return (200, {}, b'')
+
+    stand_in.respond = _respond
+
+    assert _store_plan(stand_in, tmp_path, plan_path, dir_path='a')
+    negotiated = len(stand_in.requests)
+    assert _store_plan(stand_in, tmp_path, plan_path, dir_path='b')
+
+    # The second plan goes straight to the JSON upload.
+    [(_, _, headers, body)] = stand_in.requests[negotiated:]
+    assert headers['content-type'] == 'application/json'
+    assert json.loads(body)['path'] == 'b'
+
+
+def test_store_plan_does_not_learn_from_failure(stand_in, tmp_path, plan_path):
+    stand_in.respond = lambda method, path, headers, body: (403, {}, b'')
+
+    assert not _store_plan(stand_in, tmp_path, plan_path)
+    assert workflow_step_plan._read_upload_mode(str(tmp_path)) is None
+
+
+def test_store_plan_stops_on_other_errors(stand_in, tmp_path, plan_path):
+    stand_in.respond = lambda method, path, headers, body: (403, {}, b'')
+
+    assert not _store_plan(stand_in, tmp_path, plan_path)
+    # A 403 is not a reason to try another encoding.
+    assert len(stand_in.requests) == 1
+
+
+@pytest.mark.parametrize('encoding', content_encoding.supported() + [content_encoding.IDENTITY])
+def test_load_plan_decodes_response(stand_in, tmp_path, encoding):
+    def _respond(method, path, headers, body):
+        assert encoding in headers['accept-encoding']
+        response_headers = {'content-type': 'application/octet-stream'}
+        if encoding != content_encoding.IDENTITY:
+            response_headers['content-encoding'] = encoding
+
+        return (200, response_headers, b''.join(content_encoding.compress(encoding, [PLAN])))
+
+    stand_in.respond = _respond
+
+    dest = tmp_path / 'loaded'
+    work_apply._load_plan('token', stand_in.url, 'dir', 'default', str(dest))
+
+    assert dest.read_bytes() == PLAN
+    [(method, path, _, _)] = stand_in.requests
+    assert method == 'GET'
+    assert _query(path) == {'path': 'dir', 'workspace': 'default'}
+
+
+def test_load_plan_decodes_gzipped_json_response(stand_in, tmp_path):
+    # Versions of the API without raw downloads return the plan base64 encoded
+    # in JSON, which may also be compressed.
+    body = json.dumps({'data': base64.b64encode(PLAN).decode('utf-8')}).encode('utf-8')
+    stand_in.respond = lambda method, path, headers, _: (
+        200,
+        {'content-type': 'application/json', 'content-encoding': content_encoding.GZIP},
+        gzip.compress(body))
+
+    dest = tmp_path / 'loaded'
+    work_apply._load_plan('token', stand_in.url, 'dir', 'default', str(dest))
+
+    assert dest.read_bytes() == PLAN
@@ -0,0 +1,61 @@
+import multiprocessing
+
+import retry
+
+
+def test_run_retries_until_test_passes():
+    calls = []
+    ret = retry.run(lambda: calls.append(None) or len(calls),
+                    lambda n: n >= 3,
+                    lambda: None)
+    assert ret == 3
+
+
+def test_finite_tries():
+    calls = []
+    ret = retry.run(lambda: calls.append(None) or len(calls),
+                    retry.finite_tries(2, lambda n: False),
+                    lambda: None)
+    assert ret == 2
+
+
+def test_budget_is_shared_and_runs_out():
+    bucket = retry.Token_bucket(2, 0)
+    test = retry.budget(bucket, lambda ret: False)
+    assert not test(None)
+    assert not test(None)
+    # Out of tokens, so no more retries.
+    assert test(None)
+
+
+def test_budget_is_refilled(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry.time, 'monotonic', lambda: now[0])
+    bucket = retry.Token_bucket(2, 0.5)
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+
+    now[0] += 2
+    assert bucket.take()
+    assert not bucket.take()
+
+    # Never refilled past its capacity.
+    now[0] += 1000
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def _take(bucket, q):
+    q.put(bucket.take())
+
+
+def test_budget_is_shared_across_processes():
+    bucket = retry.Token_bucket(1, 0)
+    q = multiprocessing.get_context('fork').Queue()
+    p = multiprocessing.get_context('fork').Process(target=_take, args=(bucket, q))
+    p.start()
+    p.join()
+    assert q.get() is True
+    assert not bucket.take()